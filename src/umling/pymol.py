@@ -1,6 +1,15 @@
 
-import builtins, types
+import builtins, types, itertools, heapq, os, sys, struct, ast, gc, random, hashlib, weakref
+import contextlib, contextvars, threading
+import mmap as _mmap
+import multiprocessing
+from multiprocessing import shared_memory
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
 from pyfoma import FST, State
+from pyfoma.atomic import Transition
+from pyfoma.fst import harmonize_alphabet
 
 
 #--  Sequence  -----------------------------------------------------------------
@@ -164,8 +173,11 @@ class EnumSet (Set):
     def __language__ (self):
         if not self.data:
             return EmptyLanguage()
+        words = [coerce(elt, Sequence) for elt in self]
+        if all(isinstance(sym, str) for word in words for sym in word):
+            return WordSet(words)
         else:
-            return Union(Concatenation(coerce(elt, Sequence)) for elt in self)
+            return Union(Concatenation(word) for word in words)
 
 
 def set (*elts):
@@ -244,7 +256,7 @@ def _copy_fst (fst):
     out.states = builtins.set()
     statemap = {}
     for q in fst.states:
-        outq = State(name=q.name)
+        outq = State(finalweight=q.finalweight, name=q.name)
         statemap[id(q)] = outq
         out.states.add(outq)
     out.initialstate = statemap[id(fst.initialstate)]
@@ -259,6 +271,336 @@ def _copy_fst (fst):
     return out
 
 
+def _add_arc (q1, q2, label, weight):
+    # State.add_transition() copies the set of transitions for the label,
+    # which is quadratic when a state collects many arcs with one label
+    q1.transitions.setdefault(label, builtins.set()).add(Transition(q2, label, weight))
+    q1._invalidate_transition_indexes()
+
+def _harmonized (fsts):
+    '''
+    Expand the wildcard arcs of each FST to cover the symbols that only the
+    others mention, as pyfoma does for the arguments of a binary operation.
+    '''
+    alphabet = builtins.set().union(*(fst.alphabet for fst in fsts))
+    universe = FST(alphabet=alphabet)
+    expand = harmonize_alphabet(lambda fst, universe: fst)
+    return [expand(fst, universe) if '.' in fst.alphabet else fst for fst in fsts]
+
+def _union_fsts (fsts):
+    '''
+    The union of any number of FSTs in one pass: a new initial state takes
+    copies of the arcs leaving each initial state, as in FST.union().
+    '''
+    out = FST()
+    init = out.initialstate
+    for fst in _harmonized(fsts):
+        fst = _copy_fst(fst)
+        out.states |= fst.states
+        out.finalstates |= fst.finalstates
+        out.alphabet |= fst.alphabet
+        for (label, trans) in fst.initialstate.all_transitions():
+            _add_arc(init, trans.targetstate, label, trans.weight)
+        if fst.initialstate in fst.finalstates:
+            init.finalweight = min(init.finalweight, fst.initialstate.finalweight)
+            out.finalstates.add(init)
+    return out
+
+def _concatenate_fsts (fsts):
+    '''
+    The concatenation of one or more FSTs in one pass. Each machine is copied
+    once, and the final states reached so far take copies of the arcs leaving
+    the next initial state, as in FST.concatenate().
+    '''
+    fsts = [_copy_fst(fst) for fst in _harmonized(fsts)]
+    out = fsts[0]
+    finals = {q: q.finalweight for q in out.finalstates}
+    for fst in fsts[1:]:
+        out.states |= fst.states
+        out.alphabet |= fst.alphabet
+        init = fst.initialstate
+        arcs = list(init.all_transitions())
+        for (q, weight) in finals.items():
+            for (label, trans) in arcs:
+                _add_arc(q, trans.targetstate, label, trans.weight + weight)
+        if init in fst.finalstates:
+            finals = {q: weight + init.finalweight for (q, weight) in finals.items()}
+        else:
+            finals = {}
+        for q in fst.finalstates:
+            finals[q] = q.finalweight
+    for q in out.states:
+        q.finalweight = finals.get(q, _inf)
+    out.finalstates = builtins.set(finals)
+    return out
+
+
+def _build_indexes (fst):
+    '''
+    Build the transition indexes of the states of fst. pyfoma builds them in
+    place the first time an operation such as compose() needs them, so a
+    machine that threads share must have them built before it is published,
+    lest one thread read an index that another is still filling.
+    '''
+    for q in fst.states:
+        q.transitions_by_input
+        q.transitions_by_output
+    return fst
+
+
+class SharedFST (FST):
+    '''
+    A copy-on-write handle on an FST. It shares the states of the original
+    FST, which is fine as long as it is only read. The pyfoma operations
+    copy their inputs before changing anything, so a handle can be passed to
+    them directly. Code that modifies states must call write() first, which
+    replaces the shared states with a private copy.
+    '''
+
+    def __init__ (self, fst):
+        self.alphabet = fst.alphabet.copy()
+        self.initialstate = fst.initialstate
+        self.states = fst.states
+        self.finalstates = fst.finalstates
+        self.shared = True
+
+    def write (self):
+        if self.shared:
+            self.become(_copy_fst(self))
+            self.shared = False
+        return self
+
+
+#--  Compile cache  ------------------------------------------------------------
+
+class StructureKey (tuple):
+    '''
+    The structure of a language: a tuple of a node type and its contents,
+    in which sub-languages appear as their own keys. The hash is computed
+    once, so hashing a key takes time proportional to its length rather
+    than to the size of the expression.
+    '''
+
+    def __hash__ (self):
+        h = self.__dict__.get('hash')
+        if h is None:
+            h = self.__dict__['hash'] = tuple.__hash__(self)
+        return h
+
+_identity_keys = itertools.count()
+
+class CompileCache (object):
+    '''
+    Compiled machines, keyed by the structure of the language that they
+    represent. Structurally identical sub-expressions - say, a consonant
+    class used in many rules - are compiled only once. The machines in the
+    table are shared and must not be modified, and their transition
+    indexes are built before they are stored; use new_fst() to get a
+    copy-on-write handle that the caller owns.
+    '''
+
+    def __init__ (self, maxsize=1024):
+        self.maxsize = maxsize
+        self.table = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # guards the tables only; machines are compiled outside it
+        self.lock = threading.RLock()
+
+    def lookup (self, lang):
+        '''
+        The shared machine for lang. The lock is held only to consult and
+        update the table, so that threads compile in parallel. Two threads
+        may compile the same language at once; the first machine stored is
+        the one that both get.
+        '''
+        key = lang.key()
+        with self.lock:
+            fst = self.table.get(key)
+            if fst is not None:
+                self.hits += 1
+                self.table.move_to_end(key)
+                return fst
+            self.misses += 1
+        if lang._fst is not None:
+            # the language holds its own machine; keeping it here too
+            # would only keep it alive after the language is dropped
+            return _build_indexes(lang._fst)
+        simple = lang.simplify()
+        fst = lang.__fst__() if simple is lang else self.lookup(simple)
+        assert isinstance(fst, FST), f'Bad return from __fst__(): {repr(fst)}'
+        _build_indexes(fst)
+        with self.lock:
+            return self._store_first(key, fst)
+
+    def _store_first (self, key, fst):
+        stored = self.table.get(key)
+        if stored is not None:
+            self.table.move_to_end(key)
+            return stored
+        self._store(key, fst)
+        return fst
+
+    def _store (self, key, fst):
+        self.table[key] = fst
+        self.table.move_to_end(key)
+        if self.maxsize is not None and len(self.table) > self.maxsize:
+            self.table.popitem(last=False)
+
+    def new_fst (self, lang):
+        return SharedFST(self.lookup(lang))
+
+    def optimize (self, lang, steps):
+        '''
+        Run the machine for lang through the given optimization steps. The
+        result replaces the unoptimized machine, so that it is used whenever
+        lang appears as an argument of another operation.
+        '''
+        key = (lang.key(), steps)
+        with self.lock:
+            fst = self.table.get(key)
+        if fst is None:
+            fst = self.lookup(lang)
+            for step in steps:
+                fst = optimizations[step](fst)
+            _build_indexes(fst)
+            with self.lock:
+                fst = self._store_first(key, fst)
+                self._store(lang.key(), fst)
+        lang._fst = fst
+        return fst
+
+    def clear (self):
+        with self.lock:
+            self.table.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__ (self):
+        return len(self.table)
+
+    def __repr__ (self):
+        return f'<CompileCache {len(self.table)} machines, {self.hits} hits, {self.misses} misses>'
+
+
+def clear_compile_cache ():
+    _compile_cache.clear()
+
+
+#--  Result cache  -------------------------------------------------------------
+
+class ResultCache (object):
+    '''
+    Results of lookups in one machine, keyed by the operation and the input
+    sequence. The cache holds at most maxsize entries and, if maxbytes is
+    given, results of roughly that many bytes in all. The policy decides
+    which entry is evicted first: 'lru' evicts the least recently used
+    entry, 'fifo' the oldest. The cache belongs to a particular machine, and
+    is emptied if it is consulted for a different one.
+    '''
+
+    policies = ('lru', 'fifo')
+
+    def __init__ (self, maxsize=10000, maxbytes=None, policy='lru'):
+        if policy not in self.policies:
+            raise ValueError(f'Unknown eviction policy: {policy}')
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.policy = policy
+        self.table = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.owner = None
+        self.lock = threading.Lock()
+
+    def empty_copy (self):
+        return ResultCache(self.maxsize, self.maxbytes, self.policy)
+
+    def lookup (self, fst, op, x, compute):
+        key = (op, coerce(x, Sequence))
+        with self.lock:
+            if fst is not self.owner:
+                self._clear()
+                self.owner = fst
+            entry = self.table.get(key)
+            if entry is not None:
+                self.hits += 1
+                if self.policy == 'lru':
+                    self.table.move_to_end(key)
+                return entry[0]
+            self.misses += 1
+        # computed outside the lock, so that lookups do not wait on each other
+        value = compute()
+        size = _approx_size(key) + _approx_size(value)
+        with self.lock:
+            if fst is self.owner and key not in self.table:
+                self.table[key] = (value, size)
+                self.nbytes += size
+                while self.table and ((self.maxsize is not None and len(self.table) > self.maxsize) or
+                                      (self.maxbytes is not None and self.nbytes > self.maxbytes)):
+                    (_, (_, size)) = self.table.popitem(last=False)
+                    self.nbytes -= size
+        return value
+
+    def hit_rate (self):
+        n = self.hits + self.misses
+        return self.hits / n if n else 0.
+
+    def clear (self):
+        with self.lock:
+            self._clear()
+
+    def _clear (self):
+        self.table.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__ (self):
+        return len(self.table)
+
+    def __repr__ (self):
+        return (f'<ResultCache {len(self.table)} results, {self.hits} hits, {self.misses} misses, '
+                f'hit rate {self.hit_rate():.2f}>')
+
+
+def _approx_size (x):
+    if isinstance(x, Enum):
+        return sys.getsizeof(x) + sys.getsizeof(x.elts) + sum(_approx_size(elt) for elt in x.elts)
+    elif isinstance(x, Sequence):
+        return sys.getsizeof(x) + _approx_size(x.elements)
+    elif isinstance(x, tuple):
+        return sys.getsizeof(x) + sum(_approx_size(elt) for elt in x)
+    else:
+        return sys.getsizeof(x)
+
+
+#--  Optimization  -------------------------------------------------------------
+
+optimizations = {'trim': FST.trim,
+                 'epsilon_remove': FST.epsilon_remove,
+                 'determinize': FST.determinize_as_dfa,
+                 'minimize': FST.minimize_as_dfa}
+
+default_optimization = ('epsilon_remove', 'determinize', 'minimize')
+
+def _optimization_steps (optimize):
+    if optimize is True:
+        return default_optimization
+    elif not optimize:
+        return ()
+    elif isinstance(optimize, str):
+        optimize = (optimize,)
+    steps = tuple(optimize)
+    for step in steps:
+        if step not in optimizations:
+            raise ValueError(f'Unknown optimization: {step}')
+    return steps
+
+
+#--  Language  -----------------------------------------------------------------
+
 class Language (object):
 
     istransducer = None
@@ -266,26 +608,125 @@ class Language (object):
 
     def __init__ (self):
         self._fst = None
+        self._key = None
+        self._frozen = None
+        self._simple = None
+        self._minimal = None
+        self._fingerprint = None
+        self.results = None
 
     def fst (self):
         '''
-        We must be careful - the FST operations are destructive! Any user that
-        wants to call an operation on my fst should use __fst__(), not fst().
+        The fst returned is shared. Any user that wants to modify it should
+        use __fst__(), not fst().
         '''
         if self._fst is None:
-            self._fst = self.__fst__()
-            assert isinstance(self._fst, FST), f'Bad return from __fst__(): {repr(self._fst)}'
+            self._fst = _compile_cache.lookup(self)
         return self._fst
 
     def __fst__ (self):
         '''
         Create a NEW fst representing this language, to be owned by the caller.
+        Composite languages get the fsts of their parts from the compile cache,
+        so that a shared sub-expression is compiled only once.
         '''
         return NotImplemented
 
-    def __eq__ (self, other):
+    def key (self):
+        '''
+        A StructureKey that is equal for structurally identical languages,
+        and does not depend on the state of the compile cache. A language
+        whose __key__() is None is identified by the object itself, and gets
+        a key of its own.
+        '''
+        if self._key is None:
+            structure = self.__key__()
+            if structure is None:
+                structure = ('Identity', next(_identity_keys))
+            self._key = StructureKey(structure)
+        return self._key
+
+    def __key__ (self):
         return NotImplemented
 
+    def simplify (self):
+        '''
+        Return an equivalent language with a smaller expression tree: emptyset
+        and epsilon operands are folded away, duplicate union branches are
+        dropped, nested closures are collapsed, and nested associative
+        operations are flattened. The compile cache compiles the simplified
+        tree in place of the original.
+        '''
+        if self._simple is None:
+            simple = self.__simplify__()
+            simple._simple = simple
+            self._simple = simple
+        return self._simple
+
+    def __simplify__ (self):
+        return self
+
+    def children (self):
+        return ()
+
+    def size (self):
+        '''
+        The number of nodes in the expression tree.
+        '''
+        return 1 + sum(child.size() for child in self.children())
+
+    def fingerprint (self):
+        '''
+        A digest of the canonical form of the minimal deterministic machine:
+        its live states numbered in breadth-first order, taking arcs in order
+        of label. Equivalent languages have the same fingerprint. Computed
+        once and cached. A wildcard stands for the symbols outside the
+        machine's own alphabet, so languages that use one are only found
+        equal if they also have the same alphabet.
+        '''
+        if self._fingerprint is None:
+            m = FrozenFSA(self.compile())
+            live = m._live()
+            def label (i):
+                insym = m.symbols[m.arc_in[i]]
+                return (insym, None if m.arc_out[i] == m.COPY else m.symbols[m.arc_out[i]])
+            numbers = {0: 0} if 0 in live else {}
+            states = list(numbers)
+            digest = hashlib.sha256()
+            for q in states:
+                arcs = sorted((label(i), m.arc_target[i]) for i in range(m.offsets[q], m.offsets[q+1])
+                              if m.arc_target[i] in live)
+                for (_, r) in arcs:
+                    if r not in numbers:
+                        numbers[r] = len(states)
+                        states.append(r)
+                row = (m.final[q] != _inf, [(lab, numbers[r]) for (lab, r) in arcs])
+                digest.update(repr(row).encode('utf8'))
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def equivalent (self, other):
+        '''
+        Whether the two languages contain the same strings, as decided by
+        comparing fingerprints; both are compiled. For transducers, this is
+        equivalence of the label sequences, so two transducers that align the
+        same pairs differently are not equivalent.
+        '''
+        other = coerce(other, Language)
+        return self is other or self.fingerprint() == other.fingerprint()
+
+    def __eq__ (self, other):
+        '''
+        Languages are equal if they are structurally identical, that is, if
+        they have the same key(). Nothing is compiled; use equivalent() to
+        compare the languages themselves.
+        '''
+        try:
+            other = coerce(other, Language)
+        except CoercionError:
+            return NotImplemented
+        return self is other or self.key() == other.key()
+
     def __bool__ (self):
         try:
             next(self.__iter__())
@@ -294,27 +735,148 @@ class Language (object):
             return False
 
     def __iter__ (self):
-        return iter(FSA(self.fst(), self.istransducer))
+        return iter(self.freeze())
 
     def to_fsa (self):
         return FSA(self.fst(), self.istransducer)
 
+    def freeze (self):
+        if self._frozen is None:
+            self._frozen = FrozenFSA(self)
+        return self._frozen
+
+    def contains_many (self, seqs, batchsize=4096):
+        return self.freeze().contains_many(seqs, batchsize)
+
+    def lazy_dfa (self, cachesize=10000):
+        return LazyDFA(self.freeze(), cachesize)
+
+    def is_finite (self):
+        '''
+        Whether the language is finite, decided on the compiled machine. The
+        isfinite attribute is only a guess made from the expression.
+        '''
+        return self.freeze().is_finite()
+
+    def _unambiguous (self):
+        '''
+        A frozen machine in which each string has exactly one path: the
+        frozen machine itself if it is deterministic, otherwise the compiled
+        (determinized and minimized) machine. Determinizing a transducer
+        works on its labels, and a pair may be aligned in more than one way,
+        so the result must also be input-deterministic, in which case each
+        pair has one path; otherwise this raises ValueError.
+        '''
+        if self._minimal is None:
+            frozen = self.freeze()
+            if not frozen._trim_deterministic():
+                frozen = FrozenFSA(self.compile())
+                if not frozen._trim_deterministic():
+                    raise ValueError('Transducer is not input-deterministic: a pair may have more than one path')
+            self._minimal = frozen
+        return self._minimal
+
+    def count (self):
+        '''
+        The number of strings in the language, as an int, or inf if the
+        language is infinite. Computed on a deterministic machine without
+        enumerating. A wildcard counts as a single symbol. For a transducer,
+        the number of pairs, if it is input-deterministic; otherwise
+        ValueError is raised.
+        '''
+        return self._unambiguous().count_paths()
+
+    def count_by_length (self, max_length=None):
+        '''
+        A list whose i-th element is the number of strings of length i, in
+        the sense of the shortlex order. If the language is infinite,
+        max_length must be given. Transducers are treated as in count().
+        '''
+        return self._unambiguous().count_by_length(max_length)
+
+    def sample (self, k, length=None, rng=None):
+        '''
+        A list of k strings drawn uniformly and independently from the
+        language, restricted to strings no longer than length. If the
+        language is infinite, length is required. The rng may be a
+        random.Random or a seed. A transducer gives input/output pairs, and
+        must be input-deterministic, as for count(), so that the draws are
+        uniform over pairs; otherwise ValueError is raised.
+        '''
+        return self._unambiguous().sample(k, length, rng)
+
+    def map (self, seqs, batchsize=4096):
+        return self.freeze().map(seqs, batchsize)
+
+    def apply_batch (self, xs, workers=None, chunksize=256, invert=False, n=10):
+        return apply_batch(self, xs, workers, chunksize, invert, n)
+
+    def compile (self, optimize=True):
+        '''
+        Return an FSA for this language. If optimize is true, the machine goes
+        through the default_optimization pipeline. Alternatively, optimize may
+        be a sequence of step names from the optimizations table. Optimized
+        machines are cached, and they are also used as inputs whenever this
+        language appears in a larger expression.
+        '''
+        steps = _optimization_steps(optimize)
+        if steps:
+            fst = _compile_cache.optimize(self, steps)
+        else:
+            fst = self.fst()
+        return FSA(fst, self.istransducer)
+
+    def cache_results (self, maxsize=10000, maxbytes=None, policy='lru'):
+        '''
+        Keep the results of __call__(), inv() and __contains__() in a
+        ResultCache, which is returned. Call with maxsize=0 to stop caching.
+        '''
+        self.results = ResultCache(maxsize, maxbytes, policy) if maxsize != 0 else None
+        return self.results
+
+    def _cached (self, op, x, compute):
+        if self.results is None:
+            return compute()
+        return self.results.lookup(self._results_owner(), op, x, compute)
+
+    def _results_owner (self):
+        # cached results are dropped when the owner changes
+        return self.fst()
+
     def __contains__ (self, x):
-        return self.to_fsa().__contains__(x)
+        return self._cached('contains', x, lambda: self.to_fsa().__contains__(x))
 
-    def __call__ (self, x):
-        return self.to_fsa()(x)
+    def __call__ (self, x, k=None):
+        if k is None:
+            return self._cached('call', x, lambda: self.to_fsa()(x))
+        return self._cached(('call', k), x, lambda: self.freeze()(x, k=k))
 
-    def inv (self, x):
-        return self.to_fsa().inv(x)
+    def inv (self, x, k=None):
+        if k is None:
+            return self._cached('inv', x, lambda: self.to_fsa().inv(x))
+        return self._cached(('inv', k), x, lambda: self.freeze().inv(x, k=k))
+
+    def kbest (self, x, k=5, invert=False):
+        return self.freeze().kbest(x, k, invert)
+
+    def lookup_approx (self, x, max_edits=1, k_best=10, substitution=1., insertion=1., deletion=1.):
+        return self.freeze().lookup_approx(x, max_edits, k_best, substitution, insertion, deletion)
 
     def __hash__ (self):
-        return hash(self.data)
+        return hash(self.key())
 
     def __add__ (self, other):
         other = coerce(other, Language)
         return Union([self, other])
 
+    def __and__ (self, other):
+        other = coerce(other, Language)
+        return Intersection([self, other])
+
+    def __rand__ (self, other):
+        other = coerce(other, Language)
+        return Intersection([other, self])
+
     def __sub__ (self, other):
         other = coerce(other, Language)
         return Difference([self, other])
@@ -366,6 +928,27 @@ class Language (object):
 def lg (x):
     return coerce(x, Language)
 
+def simplify (x, counts=False):
+    '''
+    The simplified form of x. If counts is true, return a pair of it and
+    the number of expression nodes that simplification removed.
+    '''
+    x = coerce(x, Language)
+    y = x.simplify()
+    if counts:
+        return (y, x.size() - y.size())
+    return y
+
+def _is_epsilon (x):
+    return type(x) is Concatenation and not x.args
+
+def _is_empty (x):
+    return isinstance(x, EmptyLanguage)
+
+def _unchanged (args, old):
+    args = list(args)
+    return len(args) == len(old) and all(x is y for (x, y) in zip(args, old))
+
 
 class Enum (object):
 
@@ -376,7 +959,14 @@ class Enum (object):
         else:
             return len(x)
 
-    def __init__ (self, x, n=10):
+    def __init__ (self, x, n=10, ordered=None):
+        '''
+        If ordered is true, x already comes in the order that Enum would sort
+        it into, and the first n elements are simply taken. By default, a
+        language is taken to be ordered, since it is iterated in shortlex order.
+        '''
+        if ordered is None:
+            ordered = isinstance(x, Language)
         elts = []
         self.truncated = False
         for (i, elt) in enumerate(x):
@@ -384,8 +974,9 @@ class Enum (object):
                 self.truncated = True
                 break
             elts.append(elt)
-        elts.sort(key=repr)
-        elts.sort(key=self.seqlen)
+        if not ordered:
+            elts.sort(key=repr)
+            elts.sort(key=self.seqlen)
         self.elts = elts
 
     def _words (self):
@@ -420,6 +1011,9 @@ class Atom (Language):
     def __fst__ (self):
         return FST(label=(_sym_to_pyfoma(self.data),))
 
+    def __key__ (self):
+        return ('Atom', type(self.data), self.data)
+
     def __bare__ (self):
         if isinstance(self.data, str):
             if not all(c.isalpha() for c in self.data):
@@ -461,6 +1055,9 @@ class Other (Language):
     def __fst__ (self):
         return FST(label=('.',))
 
+    def __key__ (self):
+        return ('Other',)
+
     def __bare__ (self):
         return self.data
 
@@ -483,6 +1080,9 @@ class EmptyLanguage (Language):
     def __fst__ (self):
         return FST()
 
+    def __key__ (self):
+        return ('EmptyLanguage',)
+
     def __bare__ (self):
         return '\u2205'
 
@@ -494,19 +1094,52 @@ def sym (x):
         return Atom(x)
 
 
+def _flatten (cls, args):
+    '''
+    Coerce args to languages, splicing in the arguments of any that are
+    themselves instances of cls.
+    '''
+    for x in args:
+        x = coerce(x, Language)
+        if type(x) is cls:
+            yield from x.args
+        else:
+            yield x
+
+
 class Union (Language):
 
     def __init__ (self, args):
         Language.__init__(self)
-        self.args = tuple(coerce(x, Language) for x in args)
+        self.args = tuple(_flatten(Union, args))
         self.istransducer = any(arg.istransducer for arg in self.args)
         self.isfinite = all(arg.isfinite for arg in self.args)
         
     def __fst__ (self):
-        fst = self.args[0].__fst__()
-        for x in self.args[1:]:
-            fst = fst.union(x.__fst__())
-        return fst
+        if len(self.args) == 1:
+            return _compile_cache.new_fst(self.args[0])
+        return _union_fsts([_compile_cache.new_fst(x) for x in self.args])
+
+    def __key__ (self):
+        return ('Union',) + tuple(arg.key() for arg in self.args)
+
+    def __simplify__ (self):
+        args = {}
+        for arg in self.args:
+            arg = arg.simplify()
+            if not _is_empty(arg):
+                args.setdefault(arg.key(), arg)
+        if not args:
+            return EmptyLanguage()
+        elif len(args) == 1:
+            return next(iter(args.values()))
+        elif _unchanged(args.values(), self.args):
+            return self
+        else:
+            return Union(args.values())
+
+    def children (self):
+        return self.args
         
     def __bare__ (self):
         if len(self.args) > 1:
@@ -526,19 +1159,27 @@ class CharRange (Language):
         if j <= i: (i, j) = (j, i)
         self.i = i
         self.j = j
-        self.istranducer = False
+        self.istransducer = False
         self.isfinite = True
 
     def __fst__ (self):
-        fst = None
+        '''
+        A range is a single pair of states with one arc per character, built
+        directly rather than as a union of one-character machines.
+        '''
+        fst = FST()
+        q = State(finalweight=0.)
+        fst.states.add(q)
+        fst.finalstates.add(q)
         for i in range(self.i, self.j):
-            charfst = FST(label=(chr(i),))
-            if fst is None:
-                fst = charfst
-            else:
-                fst = fst.union(charfst)
+            label = (_sym_to_pyfoma(chr(i)),)
+            fst.initialstate.transitions[label] = {Transition(q, label, 0.)}
+            fst.alphabet.add(label[0])
         return fst
 
+    def __key__ (self):
+        return ('CharRange', self.i, self.j)
+
     def __bare__ (self):
         return f'[{chr(self.i)}-{chr(self.j-1)}]'
 
@@ -557,10 +1198,33 @@ class Difference (Language):
         self.isfinite = self.args[0].isfinite
         
     def __fst__ (self):
-        fst = self.args[0].__fst__()
-        for x in self.args[1:]:
-            fst = fst.difference(x.__fst__())
+        fst = _compile_cache.new_fst(self.args[0])
+        if len(self.args) > 1:
+            rest = [_compile_cache.new_fst(x) for x in self.args[1:]]
+            subtrahend = rest[0] if len(rest) == 1 else _union_fsts(rest)
+            # difference() is a product construction, which is only right
+            # if the subtrahend is deterministic
+            fst = fst.difference(subtrahend.epsilon_remove().determinize_as_dfa())
         return fst
+
+    def __key__ (self):
+        return ('Difference',) + tuple(arg.key() for arg in self.args)
+
+    def __simplify__ (self):
+        first = self.args[0].simplify()
+        if _is_empty(first):
+            return first
+        args = [first] + [arg.simplify() for arg in self.args[1:]]
+        args = [first] + [arg for arg in args[1:] if not _is_empty(arg)]
+        if len(args) == 1:
+            return first
+        elif _unchanged(args, self.args):
+            return self
+        else:
+            return Difference(args)
+
+    def children (self):
+        return self.args
         
     def __bare__ (self):
         if len(self.args) > 1:
@@ -571,21 +1235,100 @@ class Difference (Language):
             raise Exception('This cannot happen')
 
 
+class Intersection (Language):
+    '''
+    The strings in all of the args, which must be acceptors. Membership is
+    tested in each arg, without building the intersection. The machine is
+    a product of the frozen args that only contains the states reachable
+    from the start, built the first time it is needed.
+    '''
+
+    def __init__ (self, args):
+        Language.__init__(self)
+        self.args = tuple(_flatten(Intersection, args))
+        assert len(self.args) > 0, 'Intersection requires arguments'
+        if any(arg.istransducer for arg in self.args):
+            raise ValueError('Intersection requires acceptors')
+        self.istransducer = False
+        self.isfinite = any(arg.isfinite for arg in self.args)
+
+    def freeze (self):
+        if self._frozen is None:
+            self._frozen = FrozenFSA.product([arg.freeze() for arg in self.args])
+        return self._frozen
+
+    def __fst__ (self):
+        return self.freeze().__fst__()
+
+    def __key__ (self):
+        return ('Intersection',) + tuple(arg.key() for arg in self.args)
+
+    def __simplify__ (self):
+        args = {}
+        for arg in self.args:
+            arg = arg.simplify()
+            if _is_empty(arg):
+                return arg
+            args.setdefault(arg.key(), arg)
+        if len(args) == 1:
+            return next(iter(args.values()))
+        elif _unchanged(args.values(), self.args):
+            return self
+        else:
+            return Intersection(args.values())
+
+    def __contains__ (self, x):
+        return self._cached('contains', x, lambda: all(x in arg for arg in self.args))
+
+    def _results_owner (self):
+        # membership does not use the product machine, so it is not built
+        return self
+
+    def children (self):
+        return self.args
+
+    def __bare__ (self):
+        if len(self.args) > 1:
+            return '(' + ' & '.join(sorted(arg.__bare__() for arg in self.args)) + ')'
+        else:
+            return self.args[0].__bare__()
+
+
 class Concatenation (Language):
 
     def __init__ (self, args):
         Language.__init__(self)
-        self.args = tuple(coerce(x, Language) for x in args)
+        self.args = tuple(_flatten(Concatenation, args))
         self.istransducer = any(arg.istransducer for arg in self.args)
         self.isfinite = all(arg.isfinite for arg in self.args)
 
     def __fst__ (self):
         if len(self.args) == 0:
             return FST(label=('',))
-        fst = self.args[0].__fst__()
-        for x in self.args[1:]:
-            fst = fst.concatenate(x.__fst__())
-        return fst
+        elif len(self.args) == 1:
+            return _compile_cache.new_fst(self.args[0])
+        return _concatenate_fsts([_compile_cache.new_fst(x) for x in self.args])
+
+    def __key__ (self):
+        return ('Concatenation',) + tuple(arg.key() for arg in self.args)
+
+    def __simplify__ (self):
+        args = []
+        for arg in self.args:
+            arg = arg.simplify()
+            if _is_empty(arg):
+                return arg
+            elif not _is_epsilon(arg):
+                args.append(arg)
+        if len(args) == 1:
+            return args[0]
+        elif _unchanged(args, self.args):
+            return self
+        else:
+            return Concatenation(args)
+
+    def children (self):
+        return self.args
 
     def __bare__ (self):
         if len(self.args) > 1:
@@ -615,7 +1358,24 @@ class KleeneClosure (Language):
         self.isfinite = False
         
     def __fst__ (self):
-        return self.arg.__fst__().kleene_closure()
+        return _compile_cache.new_fst(self.arg).kleene_closure()
+
+    def __key__ (self):
+        return ('KleeneClosure', self.arg.key())
+
+    def __simplify__ (self):
+        arg = self.arg.simplify()
+        if _is_empty(arg) or _is_epsilon(arg):
+            return Concatenation([])
+        elif isinstance(arg, (KleeneClosure, Optional)):
+            arg = arg.arg
+        if arg is self.arg:
+            return self
+        else:
+            return KleeneClosure(arg)
+
+    def children (self):
+        return (self.arg,)
         
     def __bare__ (self):
         return self.arg.__bare__() + '*'
@@ -630,11 +1390,28 @@ class Optional (Language):
     def __init__ (self, arg):
         Language.__init__(self)
         self.arg = coerce(arg, Language)
-        self.transducer = self.arg.istransducer
+        self.istransducer = self.arg.istransducer
         self.isfinite = self.arg.isfinite
 
     def __fst__ (self):
-        return self.arg.__fst__().optional()
+        return _compile_cache.new_fst(self.arg).optional()
+
+    def __key__ (self):
+        return ('Optional', self.arg.key())
+
+    def __simplify__ (self):
+        arg = self.arg.simplify()
+        if _is_empty(arg) or _is_epsilon(arg):
+            return Concatenation([])
+        elif isinstance(arg, (KleeneClosure, Optional)):
+            return arg
+        elif arg is self.arg:
+            return self
+        else:
+            return Optional(arg)
+
+    def children (self):
+        return (self.arg,)
 
     def __bare__ (self):
         return self.arg.__bare__() + '?'
@@ -655,7 +1432,22 @@ class CrossProduct (Language):
     def __fst__ (self):
         if len(self.args) != 2:
             raise Exception('Cross product (:) requires exactly two arguments')
-        return self.args[0].__fst__().cross_product(self.args[1].__fst__())
+        return _compile_cache.new_fst(self.args[0]).cross_product(_compile_cache.new_fst(self.args[1]))
+
+    def __key__ (self):
+        return ('CrossProduct',) + tuple(arg.key() for arg in self.args)
+
+    def __simplify__ (self):
+        args = [arg.simplify() for arg in self.args]
+        if any(_is_empty(arg) for arg in args):
+            return EmptyLanguage()
+        elif _unchanged(args, self.args):
+            return self
+        else:
+            return CrossProduct(args)
+
+    def children (self):
+        return self.args
 
     def __bare__ (self):
         return '(' + self.args[0].__bare__() + ':' + self.args[1].__bare__() + ')'
@@ -675,11 +1467,40 @@ class Composition (Language):
         self.isfinite = all(arg.isfinite for arg in self.args)
 
     def __fst__ (self):
-        fst = self.args[0].__fst__()
+        fst = _compile_cache.new_fst(self.args[0])
         for x in self.args[1:]:
-            fst = fst.compose(x.__fst__())
+            fst = fst.compose(_compile_cache.new_fst(x))
         return fst
 
+    def __key__ (self):
+        return ('Composition',) + tuple(arg.key() for arg in self.args)
+
+    def lazy (self, cachesize=10000):
+        '''
+        The same composition, looked up without building the composed machine.
+        '''
+        return LazyComposition(self.args, cachesize)
+
+    def __simplify__ (self):
+        args = []
+        for arg in self.args:
+            arg = arg.simplify()
+            if _is_empty(arg):
+                return arg
+            elif type(arg) is Composition:
+                args.extend(arg.args)
+            else:
+                args.append(arg)
+        if len(args) == 1:
+            return args[0]
+        elif _unchanged(args, self.args):
+            return self
+        else:
+            return Composition(args)
+
+    def children (self):
+        return self.args
+
     def __bare__ (self):
         return '(' + '@'.join(arg.__bare__() for arg in self.args) + ')'
 
@@ -698,9 +1519,22 @@ class RewriteRule (Language):
         self.isfinite = False
 
     def __fst__ (self):
-        (fst, left, right) = (arg.__fst__() for arg in self.args)
+        (fst, left, right) = (_compile_cache.new_fst(arg) for arg in self.args)
         return fst.rewrite((left, right))
 
+    def __key__ (self):
+        return ('RewriteRule',) + tuple(arg.key() for arg in self.args)
+
+    def __simplify__ (self):
+        args = [arg.simplify() for arg in self.args]
+        if _unchanged(args, self.args):
+            return self
+        else:
+            return RewriteRule(args)
+
+    def children (self):
+        return self.args
+
     def __bare__ (self):
         return '(' + ' '.join(self.args[0].__bare__(), '/', self.args[1].__bare__(), '_', self.args[2].__bare__()) + ')'
 
@@ -709,40 +1543,308 @@ def rewrite (x, y, after=None, before=None):
     return RewriteRule([io(x, y), after, before])
 
 
+#--  Word lists  ---------------------------------------------------------------
+
+def _minimal_fst (paths):
+    '''
+    Build a minimal deterministic FST accepting the given paths, each a tuple
+    of pyfoma labels. This is the incremental construction for sorted input
+    (Daciuk et al. 2000): a path is added as a fresh suffix after its common
+    prefix with the previous path, and the suffix left behind by the previous
+    path is minimized by merging each of its nodes into an equivalent
+    registered node. Labels are replaced by ints first, which makes sorting
+    and comparing paths cheap. Nodes are [final, {label: node}]. The cyclic
+    garbage collector is paused, since it would otherwise rescan the growing
+    trie many times over.
+    '''
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _minimal_fst_1(paths)
+    finally:
+        if enabled:
+            gc.enable()
+
+def _minimal_fst_1 (paths):
+    labels = {}
+    paths = sorted(builtins.set(tuple(labels.setdefault(label, len(labels)) for label in path)
+                                for path in paths))
+    register = {}
+    root = [False, {}]
+    path = [root]
+    prev = ()
+
+    def reduce (i):
+        for k in range(len(path)-1, i, -1):
+            node = path[k]
+            sig = (node[0], tuple((label, id(child)) for (label, child) in node[1].items()))
+            other = register.get(sig)
+            if other is None:
+                register[sig] = node
+            else:
+                path[k-1][1][prev[k-1]] = other
+
+    for word in paths:
+        i = 0
+        for (x, y) in zip(word, prev):
+            if x != y:
+                break
+            i += 1
+        reduce(i)
+        del path[i+1:]
+        node = path[i]
+        for label in word[i:]:
+            child = [False, {}]
+            node[1][label] = child
+            path.append(child)
+            node = child
+        node[0] = True
+        prev = word
+    reduce(0)
+    return _trie_to_fst(root, labels)
+
+def _trie_to_fst (root, labels):
+    '''
+    Convert a trie of nodes [final, {label: node}, ...] to an FST. The labels
+    table maps pyfoma labels to the ints used in the trie.
+    '''
+    labels = {i: label for (label, i) in labels.items()}
+    fst = FST()
+    fst.initialstate.name = 0
+    states = {id(root): fst.initialstate}
+    todo = [root]
+    while todo:
+        node = todo.pop()
+        q1 = states[id(node)]
+        if node[0]:
+            q1.finalweight = 0.
+            fst.finalstates.add(q1)
+        for (i, child) in node[1].items():
+            q2 = states.get(id(child))
+            if q2 is None:
+                q2 = states[id(child)] = State(name=len(states))
+                fst.states.add(q2)
+                todo.append(child)
+            label = labels[i]
+            q1.transitions[label] = {Transition(q2, label, 0.)}
+    for label in labels.values():
+        fst.alphabet.update(label)
+    return fst
+
+
+class _MinimalBuilder (object):
+    '''
+    Builds a minimal deterministic acyclic FST one path at a time, with paths
+    in any order (Daciuk et al. 2000, section 4). The machine is kept minimal
+    after every path, so memory depends on the size of the machine, not on
+    the number of paths. Adding a path that runs through a state with more
+    than one incoming arc first clones the states from there on. Nodes are
+    [final, {label: node}, indegree, signature], where the signature is None
+    for a node that is not in the register.
+    '''
+
+    def __init__ (self):
+        self.labels = {}
+        self.register = {}
+        self.root = [False, {}, 1, None]
+
+    def _unregister (self, node):
+        if node[3] is not None:
+            del self.register[node[3]]
+            node[3] = None
+
+    def _release (self, node):
+        node[2] -= 1
+        if node[2] == 0:
+            self._unregister(node)
+            for child in node[1].values():
+                self._release(child)
+
+    def add (self, path):
+        labels = self.labels
+        word = [labels.setdefault(label, len(labels)) for label in path]
+        nodes = [self.root]
+        node = self.root
+        for label in word:
+            node = node[1].get(label)
+            if node is None:
+                break
+            nodes.append(node)
+        k = len(nodes) - 1
+        if k == len(word) and nodes[k][0]:
+            return
+
+        for i in range(1, k+1):
+            if nodes[i][2] > 1:
+                break
+        else:
+            i = k + 1
+        if i <= k:
+            self._unregister(nodes[i-1])
+            for j in range(i, k+1):
+                old = nodes[j]
+                clone = [old[0], dict(old[1]), 1, None]
+                for child in old[1].values():
+                    child[2] += 1
+                old[2] -= 1
+                nodes[j-1][1][word[j-1]] = clone
+                nodes[j] = clone
+        else:
+            self._unregister(nodes[k])
+
+        node = nodes[k]
+        for label in word[k:]:
+            child = [False, {}, 1, None]
+            node[1][label] = child
+            nodes.append(child)
+            node = child
+        node[0] = True
+
+        for j in range(len(nodes)-1, 0, -1):
+            node = nodes[j]
+            if node[3] is not None:
+                break
+            sig = (node[0], tuple(sorted((label, id(child)) for (label, child) in node[1].items())))
+            other = self.register.get(sig)
+            if other is None:
+                node[3] = sig
+                self.register[sig] = node
+            else:
+                parent = nodes[j-1]
+                self._unregister(parent)
+                parent[1][word[j-1]] = other
+                other[2] += 1
+                self._release(node)
+
+    def fst (self):
+        return _trie_to_fst(self.root, self.labels)
+
+
+class WordSet (Language):
+    '''
+    A finite set of words, where a word is a sequence of string symbols. It
+    means the same as the union of the words, but it compiles directly to a
+    minimal deterministic acceptor instead of folding the words in one at a
+    time.
+    '''
+
+    def __init__ (self, words):
+        Language.__init__(self)
+        self.words = tuple(coerce(word, Sequence) for word in words)
+        self.istransducer = False
+        self.isfinite = True
+
+    def __fst__ (self):
+        return _minimal_fst(tuple((_sym_to_pyfoma(sym),) for sym in word) for word in self.words)
+
+    def __key__ (self):
+        return ('WordSet', frozenset(tuple(word) for word in self.words))
+
+    def __bare__ (self):
+        return Union(Concatenation(word) for word in self.words).__bare__()
+
+
+def _lexicon_pairs (source, tokenize):
+    if isinstance(source, str):
+        with open(source, encoding='utf8') as f:
+            yield from _lexicon_pairs(f, tokenize)
+        return
+    for item in source:
+        if isinstance(item, str):
+            item = item.rstrip('\r\n')
+            if not item:
+                continue
+            item = item.split('\t')
+            if len(item) == 1:
+                item = item * 2
+            elif len(item) != 2:
+                raise ValueError(f'Expecting a surface form and an analysis: {item}')
+        (x, y) = item
+        yield (tokenize(x) if isinstance(x, str) else x,
+               tokenize(y) if isinstance(y, str) else y)
+
+def lexicon (source, tokenize=letters):
+    '''
+    Compile a transducer from (surface, analysis) pairs. The source is either
+    a filename for a table with one tab-separated pair per line, or an
+    iterable over such lines or over pairs. Strings are split into symbols
+    by tokenize; sequences are used as they are. The pairs are read one at a
+    time into a minimal machine, which shares prefixes and suffixes, and the
+    symbols of each pair are aligned from the left.
+    '''
+    builder = _MinimalBuilder()
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for (x, y) in _lexicon_pairs(source, tokenize):
+            path = []
+            for (a, b) in itertools.zip_longest(x, y, fillvalue=''):
+                (a, b) = (_sym_to_pyfoma(a), _sym_to_pyfoma(b))
+                path.append((a,) if a == b else (a, b))
+            builder.add(path)
+        fst = builder.fst()
+    finally:
+        if enabled:
+            gc.enable()
+    return FSA(fst, None)
+
+
 #--  FSABuilder  ---------------------------------------------------------------
 
 class FSABuilder (object):
+    '''
+    Builds an FSA edge by edge. States are found through an index from state
+    names, and duplicate edges through a set of (source, label, target)
+    triples, so that each edge costs constant time.
+    '''
 
     def __init__ (self):
         self.fst = None
         self.istransducer = False
+        self.states = None
+        self.edges = None
+        self.results = None
 
-    def _require_fsa (self):
+    def _require_fsa (self, initial=1):
         if self.fst is None:
             self.fst = FST()
-            self.fst.initialstate.name = 1
+            self.fst.initialstate.name = initial
         return self.fst
 
-    def _require_state (self, q):
+    def _require_index (self):
         fst = self._require_fsa()
-        for state in fst.states:
-            if state.name == q:
-                return state
-        state = State(name=q)
-        fst.states.add(state)
+        if isinstance(fst, SharedFST):
+            fst.write()
+        if self.states is None:
+            self.states = {}
+            self.edges = builtins.set()
+            for state in fst.states:
+                self.states.setdefault(state.name, state)
+                for (label, trans) in state.all_transitions():
+                    self.edges.add((state, label, trans.targetstate))
+        return fst
+
+    def _require_state (self, q):
+        state = self.states.get(q)
+        if state is None:
+            state = self.states[q] = State(name=q)
+            self.fst.states.add(state)
         return state
 
-    def _get_transition (self, q1, label, q2):
-        if label in q1.transitions:
-            for trans in q1.transitions[label]:
-                if trans.targetstate == q2:
-                    return trans
+    def _add_edge (self, q1, label, q2, weight=0.):
+        q1 = self._require_state(q1)
+        q2 = self._require_state(q2)
+        if (q1, label, q2) not in self.edges:
+            self.edges.add((q1, label, q2))
+            _add_arc(q1, q2, label, weight)
+            for sym in label:
+                self.fst.alphabet.add(sym)
 
     @staticmethod
     def _de_epsilon (sym):
         return '' if sym == epsilon else sym
 
-    def E (self, *args):
+    def _edge (self, args):
         if len(args) == 2:
             (q1, q2) = args
             label = ('',)
@@ -755,34 +1857,91 @@ class FSABuilder (object):
             self.istransducer = True
         else:
             raise Exception('Too many arguments to E')
+        return (q1, label, q2)
 
-        q1 = self._require_state(q1)
-        q2 = self._require_state(q2)
-        if not self._get_transition(q1, label, q2):
-            q1.add_transition(q2, label, 0.)
-            for sym in label:
-                self.fst.alphabet.add(sym)
+    def E (self, *args, weight=0.):
+        self._require_index()
+        self._add_edge(*self._edge(args), weight)
+
+    def E_many (self, edges):
+        '''
+        Add many edges at once. Each edge is a tuple of arguments for E().
+        '''
+        self._require_index()
+        for args in edges:
+            self._add_edge(*self._edge(args))
 
-    def F (self, q):
+    def F (self, q, weight=0.):
+        self._require_index()
         q = self._require_state(q)
-        if q not in self.fst.finalstates:
-            q.finalweight = 0.
-            self.fst.finalstates.add(q)
+        q.finalweight = weight
+        self.fst.finalstates.add(q)
+
+    def read_att (self, source, epsilon='@0@'):
+        '''
+        Add the edges and final states in an AT&T-format table, given as a
+        filename or as an iterable over lines. A line with four or five
+        fields is an edge (source, target, input, output, and optionally a
+        weight); a line with one or two fields is a final state. Numeric
+        state names are converted to ints. If the builder is empty, the
+        state on the first line, of either kind, becomes the initial state.
+        '''
+        if isinstance(source, str):
+            with open(source, encoding='utf8') as f:
+                return self.read_att(f, epsilon)
+        def state (name):
+            return int(name) if name.isdigit() else name
+        def sym (s):
+            return '' if s == epsilon else s
+        for line in source:
+            fields = line.rstrip('\r\n').split('\t')
+            if not fields[0]:
+                continue
+            if len(fields) in (1, 2):
+                self._require_fsa(initial=state(fields[0]))
+                self._require_index()
+                q = self._require_state(state(fields[0]))
+                if q not in self.fst.finalstates:
+                    q.finalweight = float(fields[1]) if len(fields) == 2 else 0.
+                    self.fst.finalstates.add(q)
+            elif len(fields) in (3, 4, 5):
+                if len(fields) == 3:
+                    fields.insert(3, fields[2])
+                q1 = state(fields[0])
+                self._require_fsa(initial=q1)
+                self._require_index()
+                (insym, outsym) = (sym(fields[2]), sym(fields[3]))
+                if insym == outsym:
+                    label = (insym,)
+                else:
+                    label = (insym, outsym)
+                    self.istransducer = True
+                weight = float(fields[4]) if len(fields) == 5 else 0.
+                self._add_edge(q1, label, state(fields[1]), weight)
+            else:
+                raise ValueError(f'Bad line in AT&T table: {line!r}')
 
     def make_fsa (self):
         self._require_fsa() # create an empty one if none exists
         fsa = FSA(self.fst, self.istransducer)
+        if self.results is not None:
+            fsa.results = self.results.empty_copy()
         self.erase_fsa()
         return fsa
 
     def erase_fsa (self):
         self.fst = None
         self.istransducer = False
+        self.states = None
+        self.edges = None
+        self.results = None
 
     def edit_fsa (self, fsa):
         assert isinstance(fsa, Language), f'Can only edit FSAs or languages: {fsa}'
-        self.fst = fsa.__fst__()
+        self.erase_fsa()
+        self.fst = _compile_cache.new_fst(fsa)
         self.istransducer = fsa.istransducer
+        self.results = fsa.results
 
 
 class FSA (Language):
@@ -797,7 +1956,10 @@ class FSA (Language):
         self.istransducer = self.compute_istransducer() if istransducer is None else istransducer
 
     def __fst__ (self):
-        return _copy_fst(self._fst)
+        return SharedFST(self._fst)
+
+    def __key__ (self):
+        return None
 
     def compute_istransducer (self):
         return any(len(label) > 1 for label in self.labels())
@@ -811,13 +1973,13 @@ class FSA (Language):
         return set(self._labels())
 
     def __iter__ (self):
-        visited = builtins.set()
-        for item in self._iter1():
-            if item not in visited:
-                yield item
-                visited.add(item)
+        return iter(self.freeze())
 
-    def _iter1 (self):
+    def _iter1 (self, costs=False):
+        '''
+        The strings (or pairs) in the order pyfoma's words() produces them,
+        with their costs if costs is true.
+        '''
         fst = self._fst
         if self.istransducer:
             for (cost, pairseq) in fst.words():
@@ -835,26 +1997,52 @@ class FSA (Language):
                             outsyms.append(pair[1])
                     else:
                         raise Exception(f'Unexpected pair: {pair}')
-                yield (_from_pyfoma(insyms), _from_pyfoma(outsyms))
+                pair = (_from_pyfoma(insyms), _from_pyfoma(outsyms))
+                yield (pair, cost) if costs else pair
         else:
             for (cost, pairseq) in fst.words():
-                yield _from_pyfoma(pair[0] for pair in pairseq)
+                x = _from_pyfoma(pair[0] for pair in pairseq)
+                yield (x, cost) if costs else x
 
     def _call (self, x, invert=False):
         x = coerce(x, Sequence)
         fst = self._fst
-        fst.tokenize_against_alphabet = lambda x: x
+        # a list input is not tokenized, so nothing in fst is modified
         insyms = [_sym_to_pyfoma(sym) for sym in x]
         fnc = fst.analyze if invert else fst.generate
         return (_from_pyfoma(y) for y in fnc(insyms, tokenize_outputs=True))
 
-    def __call__ (self, x, invert=False):
-        return Enum(self._call(x, invert=invert))
+    def __call__ (self, x, invert=False, k=None):
+        '''
+        The outputs for input x. If k is given, the k cheapest outputs in
+        order of cost, found by a best-first search on the frozen machine
+        that stops early; otherwise the first ten, in shortlex order.
+        '''
+        op = 'inv' if invert else 'call'
+        if k is None:
+            return self._cached(op, x, lambda: Enum(self._call(x, invert=invert)))
+        return self._cached((op, k), x, lambda: self.freeze()(x, invert=invert, k=k))
 
-    def inv (self, x):
-        return self.__call__(x, invert=True)
+    def inv (self, x, k=None):
+        return self.__call__(x, invert=True, k=k)
+
+    def kbest (self, x, k=5, invert=False):
+        '''
+        A list of up to k (output, cost) pairs for input x, cheapest first.
+        '''
+        return self.freeze().kbest(x, k, invert)
+
+    def lookup_approx (self, x, max_edits=1, k_best=10, substitution=1., insertion=1., deletion=1.):
+        '''
+        Outputs for the strings within max_edits edits of x; see
+        FrozenFSA.lookup_approx().
+        '''
+        return self.freeze().lookup_approx(x, max_edits, k_best, substitution, insertion, deletion)
 
     def __contains__ (self, x):
+        return self._cached('contains', x, lambda: self._contains(x))
+
+    def _contains (self, x):
         try:
             next(self._call(x))
             return True
@@ -875,6 +2063,1636 @@ class FSA (Language):
         return self.__bare__()
 
 
+#--  Current builder  ----------------------------------------------------------
+#
+#  E(), F(), make_fsa() and the rest work on the current builder. Each thread
+#  gets its own, and builder_context() gives a block of code - say, the body
+#  of an asyncio task - a fresh one.
+
+def current_builder ():
+    entry = _fsa_builders.get(None)
+    if entry is None or entry[0] != threading.get_ident():
+        entry = (threading.get_ident(), FSABuilder())
+        _fsa_builders.set(entry)
+    return entry[1]
+
+@contextlib.contextmanager
+def builder_context ():
+    builder = FSABuilder()
+    token = _fsa_builders.set((threading.get_ident(), builder))
+    try:
+        yield builder
+    finally:
+        _fsa_builders.reset(token)
+
+def E (*args, weight=0.):
+    current_builder().E(*args, weight=weight)
+
+def E_many (edges):
+    current_builder().E_many(edges)
+
+def F (q, weight=0.):
+    current_builder().F(q, weight)
+
+def read_att (source, epsilon='@0@'):
+    current_builder().read_att(source, epsilon)
+
+def make_fsa ():
+    return current_builder().make_fsa()
+
+def erase_fsa ():
+    current_builder().erase_fsa()
+
+def edit (fsa):
+    current_builder().edit_fsa(fsa)
+
+
+#--  FrozenFSA  ---------------------------------------------------------------
+
+class FrozenFSA (Language):
+    '''
+    A read-only machine stored in flat arrays, for fast lookup. States are
+    numbered from 0 (the initial state), and symbols are interned in a
+    symbol table in which 0 is epsilon. The arcs leaving state q are
+    arc_in[i], arc_out[i], arc_target[i], arc_weight[i] for i in
+    range(offsets[q], offsets[q+1]), sorted by input symbol. An arc_out of
+    COPY marks the identity wildcard ('.',), which outputs its input symbol.
+    A state is final if its final weight is not infinite.
+    '''
+
+    COPY = -1
+
+    def __init__ (self, x):
+        Language.__init__(self)
+        x = coerce(x, Language)
+        fst = x.fst()
+        symbol_ids = {'': 0}
+        def intern (sym):
+            i = symbol_ids.get(sym)
+            if i is None:
+                i = symbol_ids[sym] = len(symbol_ids)
+            return i
+        for sym in fst.alphabet:
+            intern(sym)
+        state_ids = {fst.initialstate: 0}
+        states = [fst.initialstate]
+        arcs = []
+        istransducer = False
+        for (q, state) in enumerate(states):
+            for (label, trans) in state.all_transitions():
+                if label == ('.',):
+                    (insym, outsym) = (intern('.'), self.COPY)
+                else:
+                    (insym, outsym) = (intern(label[0]), intern(label[-1]))
+                    if len(label) > 1:
+                        istransducer = True
+                target = state_ids.get(trans.targetstate)
+                if target is None:
+                    target = state_ids[trans.targetstate] = len(states)
+                    states.append(trans.targetstate)
+                arcs.append((q, insym, outsym, target, trans.weight))
+        final = array('d', (q.finalweight if q in fst.finalstates else _inf for q in states))
+        symbols = [None] * len(symbol_ids)
+        for (sym, i) in symbol_ids.items():
+            symbols[i] = sym
+        if x.istransducer is not None:
+            istransducer = x.istransducer
+        self._set_arcs(symbols, len(states), arcs, final, istransducer)
+
+    @classmethod
+    def from_arrays (cls, symbols, offsets, arc_in, arc_out, arc_target, arc_weight, final, istransducer):
+        self = cls.__new__(cls)
+        Language.__init__(self)
+        self._set_arrays(symbols, offsets, arc_in, arc_out, arc_target, arc_weight, final, istransducer)
+        return self
+
+    @classmethod
+    def _from_arcs (cls, symbols, nstates, arcs, final, istransducer):
+        self = cls.__new__(cls)
+        Language.__init__(self)
+        self._set_arcs(symbols, nstates, arcs, final, istransducer)
+        return self
+
+    @classmethod
+    def product (cls, machines):
+        '''
+        The intersection of acceptors, as the part of their product that is
+        reachable from the tuple of initial states. At each tuple, every
+        symbol on an arc of some machine is tried in all of them; a machine
+        whose alphabet lacks the symbol reads it with a wildcard arc, if it
+        has one. Epsilon arcs move one machine at a time.
+        '''
+        symbol_ids = {'': 0}
+        for m in machines:
+            for sym in m.symbols:
+                symbol_ids.setdefault(sym, len(symbol_ids))
+        symbols = [None] * len(symbol_ids)
+        for (sym, i) in symbol_ids.items():
+            symbols[i] = sym
+        wildcard = symbol_ids.get('.')
+        start = (0,) * len(machines)
+        state_ids = {start: 0}
+        states = [start]
+        arcs = []
+        def target (qs):
+            r = state_ids.get(qs)
+            if r is None:
+                r = state_ids[qs] = len(states)
+                states.append(qs)
+            return r
+        for (q, qs) in enumerate(states):
+            for (j, m) in enumerate(machines):
+                for i in range(m.offsets[qs[j]], m.offsets[qs[j]+1]):
+                    if m.arc_in[i] == 0:
+                        r = target(qs[:j] + (m.arc_target[i],) + qs[j+1:])
+                        arcs.append((q, 0, 0, r, m.arc_weight[i]))
+            candidates = builtins.set()
+            for (j, m) in enumerate(machines):
+                for i in range(m.offsets[qs[j]], m.offsets[qs[j]+1]):
+                    if m.arc_in[i]:
+                        candidates.add(m.symbols[m.arc_in[i]])
+            for sym in candidates:
+                choices = [[(t, w) for (_, t, w) in m._step(q1, sym)] for (m, q1) in zip(machines, qs)]
+                if not all(choices):
+                    continue
+                insym = symbol_ids[sym]
+                outsym = cls.COPY if insym == wildcard else insym
+                for combination in itertools.product(*choices):
+                    r = target(tuple(t for (t, _) in combination))
+                    arcs.append((q, insym, outsym, r, sum(w for (_, w) in combination)))
+        final = array('d', (sum(m.final[q] for (m, q) in zip(machines, qs)) for qs in states))
+        return cls._from_arcs(symbols, len(states), arcs, final, False)
+
+    def _set_arrays (self, symbols, offsets, arc_in, arc_out, arc_target, arc_weight, final, istransducer):
+        self.symbols = symbols
+        self.symbol_ids = {sym: i for (i, sym) in enumerate(symbols)}
+        self.offsets = offsets
+        self.arc_in = arc_in
+        self.arc_out = arc_out
+        self.arc_target = arc_target
+        self.arc_weight = arc_weight
+        self.final = final
+        self.istransducer = istransducer
+        self.isfinite = None
+        self._inverse = None
+        self._deterministic = None
+        self._dense = None
+        self._coaccessible = None
+        self._sample_tables = {}
+        self.buffer = None
+
+    def __getstate__ (self):
+        arrays = [a if isinstance(a, array) else array(a.format, a.tobytes())
+                  for a in (self.offsets, self.arc_in, self.arc_out, self.arc_target,
+                            self.arc_weight, self.final)]
+        return (self.symbols, *arrays, self.istransducer)
+
+    def __setstate__ (self, state):
+        Language.__init__(self)
+        self._set_arrays(*state)
+
+    def _set_arcs (self, symbols, nstates, arcs, final, istransducer):
+        arcs.sort(key=lambda arc: arc[:3])
+        offsets = array('q', bytes(8 * (nstates + 1)))
+        for arc in arcs:
+            offsets[arc[0] + 1] += 1
+        for q in range(nstates):
+            offsets[q + 1] += offsets[q]
+        self._set_arrays(symbols, offsets,
+                         array('q', (arc[1] for arc in arcs)),
+                         array('q', (arc[2] for arc in arcs)),
+                         array('q', (arc[3] for arc in arcs)),
+                         array('d', (arc[4] for arc in arcs)),
+                         final, istransducer)
+
+    def __key__ (self):
+        return None
+
+    def __fst__ (self):
+        fst = FST()
+        states = [fst.initialstate] + [State() for q in range(1, self.nstates())]
+        fst.states = builtins.set(states)
+        fst.alphabet = builtins.set(sym for sym in self.symbols if sym)
+        for q in range(self.nstates()):
+            for i in range(self.offsets[q], self.offsets[q+1]):
+                insym = self.symbols[self.arc_in[i]]
+                if self.arc_out[i] == self.COPY:
+                    label = (insym,)
+                else:
+                    outsym = self.symbols[self.arc_out[i]]
+                    label = (insym,) if insym == outsym else (insym, outsym)
+                states[q].add_transition(states[self.arc_target[i]], label, self.arc_weight[i])
+            if self.final[q] != _inf:
+                states[q].finalweight = self.final[q]
+                fst.finalstates.add(states[q])
+        return fst
+
+    def nstates (self):
+        return len(self.final)
+
+    def narcs (self):
+        return len(self.arc_in)
+
+    def inverse (self):
+        '''
+        The frozen machine with input and output exchanged, used by inv().
+        '''
+        if self._inverse is None:
+            arcs = []
+            for q in range(self.nstates()):
+                for i in range(self.offsets[q], self.offsets[q+1]):
+                    (insym, outsym) = (self.arc_in[i], self.arc_out[i])
+                    if outsym != self.COPY:
+                        (insym, outsym) = (outsym, insym)
+                    arcs.append((q, insym, outsym, self.arc_target[i], self.arc_weight[i]))
+            inverse = FrozenFSA._from_arcs(self.symbols, self.nstates(), arcs, self.final, self.istransducer)
+            inverse._inverse = self
+            self._inverse = inverse
+        return self._inverse
+
+    def _encode (self, x):
+        x = coerce(x, Sequence)
+        ids = self.symbol_ids
+        other_id = ids.get('.')
+        word = []
+        for sym in x:
+            sym = _sym_to_pyfoma(sym)
+            word.append((ids.get(sym, other_id), sym))
+        return word
+
+    def _apply (self, x, costs=False):
+        '''
+        Generate the distinct outputs for input x, cheapest first, or
+        (output, cost) pairs if costs is true. This is a best-first search,
+        so taking the first k outputs does only the work needed to find
+        them; it assumes that weights are not negative. Only states from
+        which the rest of the input can be accepted are visited, so the
+        search never wanders down dead ends, even infinite ones. Outputs are
+        built as linked (symbol, rest) pairs, to avoid copying lists.
+        '''
+        word = self._encode(x)
+        n = len(word)
+        viable = self._viable(word)
+        if 0 not in viable[0]:
+            return
+        (offsets, arc_in, arc_out, arc_target, arc_weight, final) = \
+            (self.offsets, self.arc_in, self.arc_out, self.arc_target, self.arc_weight, self.final)
+        symbols = self.symbols
+        COPY = self.COPY
+        counter = itertools.count()
+        queue = [(0.0, 0, next(counter), None, 0)]
+        visited = {}
+        seen = builtins.set()
+        while queue:
+            (cost, negpos, _, output, q) = heapq.heappop(queue)
+            pos = -negpos
+            if q < 0:
+                syms = []
+                while output is not None:
+                    (sym, output) = output
+                    syms.append(sym)
+                syms.reverse()
+                y = _from_pyfoma(syms)
+                if y not in seen:
+                    seen.add(y)
+                    yield (y, cost) if costs else y
+                continue
+            # Keeping the output in the table keeps its id from being reused
+            key = (pos, q, id(output))
+            if key in visited:
+                continue
+            visited[key] = output
+            if final[q] != _inf and pos == n:
+                heapq.heappush(queue, (cost + final[q], negpos, next(counter), output, -1))
+            lo = offsets[q]
+            hi = offsets[q+1]
+            i = lo
+            while i < hi and arc_in[i] == 0:
+                if arc_target[i] in viable[pos]:
+                    out = symbols[arc_out[i]]
+                    heapq.heappush(queue, (cost + arc_weight[i], negpos, next(counter),
+                                           (out, output) if out else output, arc_target[i]))
+                i += 1
+            if pos < n:
+                (insym, sym) = word[pos]
+                j = bisect_left(arc_in, insym, i, hi)
+                k = bisect_right(arc_in, insym, j, hi)
+                for j in range(j, k):
+                    if arc_target[j] in viable[pos+1]:
+                        out = sym if arc_out[j] == COPY else symbols[arc_out[j]]
+                        heapq.heappush(queue, (cost + arc_weight[j], negpos - 1, next(counter),
+                                               (out, output) if out else output, arc_target[j]))
+
+    def _viable (self, word):
+        '''
+        For each position in the encoded word, the set of states from which
+        the rest of the word can be accepted. A forward pass finds the states
+        reachable at each position, and a backward pass keeps those that
+        lead on to acceptance, so the work is proportional to the part of
+        the machine that the word actually touches.
+        '''
+        (offsets, arc_in, arc_target, final) = (self.offsets, self.arc_in, self.arc_target, self.final)
+        n = len(word)
+        def epsilon_arcs (q):
+            i = offsets[q]
+            while i < offsets[q+1] and arc_in[i] == 0:
+                yield i
+                i += 1
+        def reading_arcs (q, insym):
+            (lo, hi) = (offsets[q], offsets[q+1])
+            j = bisect_left(arc_in, insym, lo, hi)
+            while j < hi and arc_in[j] == insym:
+                yield j
+                j += 1
+        reached = [builtins.set() for pos in range(n + 1)]
+        agenda = [0]
+        reached[0].add(0)
+        for pos in range(n + 1):
+            while agenda:
+                for i in epsilon_arcs(agenda.pop()):
+                    if arc_target[i] not in reached[pos]:
+                        reached[pos].add(arc_target[i])
+                        agenda.append(arc_target[i])
+            if pos == n:
+                break
+            insym = word[pos][0]
+            if insym is None or insym == 0:
+                return [builtins.set()] * (n + 1)
+            for q in reached[pos]:
+                for i in reading_arcs(q, insym):
+                    reached[pos+1].add(arc_target[i])
+            agenda = list(reached[pos+1])
+        viable = [None] * (n + 1)
+        for pos in range(n, -1, -1):
+            if pos == n:
+                good = builtins.set(q for q in reached[n] if final[q] != _inf)
+            else:
+                after = viable[pos+1]
+                good = builtins.set(q for q in reached[pos]
+                                    if any(arc_target[i] in after for i in reading_arcs(q, word[pos][0])))
+            # states that reach a good state by epsilon arcs are good too
+            changed = True
+            while changed:
+                changed = False
+                for q in reached[pos]:
+                    if q not in good and any(arc_target[i] in good for i in epsilon_arcs(q)):
+                        good.add(q)
+                        changed = True
+            viable[pos] = good
+        return viable
+
+    def _live (self):
+        '''
+        The states from which a final state can be reached.
+        '''
+        if self._coaccessible is None:
+            incoming = [[] for q in range(self.nstates())]
+            for q in range(self.nstates()):
+                for i in range(self.offsets[q], self.offsets[q+1]):
+                    incoming[self.arc_target[i]].append(q)
+            live = builtins.set(q for q in range(self.nstates()) if self.final[q] != _inf)
+            agenda = list(live)
+            while agenda:
+                for q in incoming[agenda.pop()]:
+                    if q not in live:
+                        live.add(q)
+                        agenda.append(q)
+            self._coaccessible = live
+        return self._coaccessible
+
+    def _trim (self):
+        '''
+        The states that are both reachable from the initial state and live,
+        in the order they are reached.
+        '''
+        live = self._live()
+        if 0 not in live:
+            return []
+        seen = {0}
+        states = [0]
+        for q in states:
+            for i in range(self.offsets[q], self.offsets[q+1]):
+                r = self.arc_target[i]
+                if r in live and r not in seen:
+                    seen.add(r)
+                    states.append(r)
+        return states
+
+    def _trim_deterministic (self):
+        '''
+        Like is_deterministic(), but only counting the arcs between states
+        that are reachable and live, which are the ones on accepting paths.
+        '''
+        trim = builtins.set(self._trim())
+        for q in trim:
+            insyms = [self.arc_in[i] for i in range(self.offsets[q], self.offsets[q+1])
+                      if self.arc_target[i] in trim]
+            if 0 in insyms or len(insyms) != len(builtins.set(insyms)):
+                return False
+        return True
+
+    def _arc_length (self, i):
+        '''
+        The contribution of arc i to the length of a string, as used by the
+        shortlex order: one per nonempty side for a transducer.
+        '''
+        (insym, outsym) = (self.arc_in[i], self.arc_out[i])
+        if not self.istransducer:
+            return 1 if insym else 0
+        elif outsym == self.COPY:
+            return 2
+        else:
+            return bool(insym) + bool(outsym)
+
+    def _components (self):
+        '''
+        The strongly connected components of the trimmed machine, as lists of
+        states, sinks first (Tarjan's algorithm, without recursion).
+        '''
+        (offsets, arc_target) = (self.offsets, self.arc_target)
+        states = self._trim()
+        trim = builtins.set(states)
+        index = {}
+        lowlink = {}
+        stack = []
+        onstack = builtins.set()
+        components = []
+        for root in states:
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            onstack.add(root)
+            work = [(root, offsets[root])]
+            while work:
+                (q, i) = work[-1]
+                if i < offsets[q+1]:
+                    work[-1] = (q, i + 1)
+                    r = arc_target[i]
+                    if r not in trim:
+                        continue
+                    if r not in index:
+                        index[r] = lowlink[r] = len(index)
+                        stack.append(r)
+                        onstack.add(r)
+                        work.append((r, offsets[r]))
+                    elif r in onstack:
+                        lowlink[q] = min(lowlink[q], index[r])
+                    continue
+                work.pop()
+                if work:
+                    p = work[-1][0]
+                    lowlink[p] = min(lowlink[p], lowlink[q])
+                if lowlink[q] == index[q]:
+                    component = []
+                    while True:
+                        r = stack.pop()
+                        onstack.discard(r)
+                        component.append(r)
+                        if r == q:
+                            break
+                    components.append(component)
+        return components
+
+    def _cyclic_arcs (self):
+        '''
+        The arcs of the trimmed machine that lie on a cycle.
+        '''
+        (offsets, arc_target) = (self.offsets, self.arc_target)
+        for component in self._components():
+            members = builtins.set(component)
+            for q in component:
+                for i in range(offsets[q], offsets[q+1]):
+                    if arc_target[i] in members:
+                        yield i
+
+    def is_finite (self):
+        '''
+        Exact: the language is infinite just in case some cycle through
+        states that are reachable and live reads or writes a symbol.
+        '''
+        if self.isfinite is None:
+            self.isfinite = not any(self._arc_length(i) for i in self._cyclic_arcs())
+        return self.isfinite
+
+    def count_paths (self):
+        '''
+        The number of accepting paths, as an int, or inf if there is a
+        cycle on an accepting path. This is the number of strings if the
+        machine is deterministic; Language.count() ensures that it is.
+        '''
+        (offsets, arc_target) = (self.offsets, self.arc_target)
+        counts = {}
+        for component in self._components():
+            if len(component) > 1:
+                return _inf
+            q = component[0]
+            n = 1 if self.final[q] != _inf else 0
+            for i in range(offsets[q], offsets[q+1]):
+                r = arc_target[i]
+                if r == q:
+                    return _inf
+                n += counts.get(r, 0)
+            counts[q] = n
+        return counts.get(0, 0)
+
+    def count_by_length (self, max_length=None):
+        '''
+        A list whose i-th element is the number of accepting paths whose
+        strings have length i. Requires max_length if the language is
+        infinite. Counts are carried forward one length at a time, so the
+        work is proportional to the number of arcs times the lengths.
+        '''
+        if max_length is None and not self.is_finite():
+            raise ValueError('Infinite language: max_length is required')
+        (offsets, arc_target) = (self.offsets, self.arc_target)
+        trim = builtins.set(self._trim())
+        epsilon_order = self._epsilon_order(trim)
+        levels = {0: {0: 1}} if trim else {}
+        counts = []
+        length = 0
+        while levels and (max_length is None or length <= max_length):
+            level = levels.pop(length, {})
+            for q in epsilon_order:
+                n = level.get(q)
+                if n:
+                    for i in range(offsets[q], offsets[q+1]):
+                        r = arc_target[i]
+                        if r in trim and not self._arc_length(i):
+                            level[r] = level.get(r, 0) + n
+            counts.append(sum(n for (q, n) in level.items() if self.final[q] != _inf))
+            for (q, n) in level.items():
+                for i in range(offsets[q], offsets[q+1]):
+                    r = arc_target[i]
+                    k = self._arc_length(i)
+                    if k and r in trim:
+                        following = levels.setdefault(length + k, {})
+                        following[r] = following.get(r, 0) + n
+            length += 1
+        if max_length is None:
+            while counts and not counts[-1]:
+                counts.pop()
+        else:
+            counts.extend([0] * (max_length + 1 - len(counts)))
+        return counts
+
+    def _sample_table (self, length):
+        '''
+        Returns (states, table), where table[r][q] is the number of accepting
+        paths from state q whose strings have length at most r. Kept on the
+        machine, one table per length.
+        '''
+        table = self._sample_tables.get(length)
+        if table is None:
+            (offsets, arc_target) = (self.offsets, self.arc_target)
+            trim = builtins.set(self._trim())
+            order = self._epsilon_order(trim)[::-1]
+            table = []
+            for r in range(length + 1):
+                row = [0] * self.nstates()
+                for q in order:
+                    n = 1 if self.final[q] != _inf else 0
+                    for i in range(offsets[q], offsets[q+1]):
+                        t = arc_target[i]
+                        if t in trim:
+                            k = self._arc_length(i)
+                            if k == 0:
+                                n += row[t]
+                            elif k <= r:
+                                n += table[r-k][t]
+                    row[q] = n
+                table.append(row)
+            self._sample_tables[length] = table
+        return table
+
+    def sample (self, k, length=None, rng=None):
+        '''
+        Draw k accepting paths uniformly, among those whose strings have
+        length at most length, and return their strings (or input/output
+        pairs). Uniform over paths is uniform over strings only if each
+        string has one path, as in a deterministic machine; in a transducer,
+        a pair with several alignments is drawn once per alignment. Each
+        draw takes time proportional to the length of the path times the
+        number of arcs per state.
+        '''
+        if length is None:
+            if not self.is_finite():
+                raise ValueError('Infinite language: length is required')
+            length = len(self.count_by_length()) - 1
+        table = self._sample_table(max(length, 0))
+        if not table[-1][0]:
+            raise ValueError('No strings to sample')
+        if not isinstance(rng, random.Random):
+            rng = random.Random(rng)
+        (offsets, arc_in, arc_out, arc_target, symbols) = \
+            (self.offsets, self.arc_in, self.arc_out, self.arc_target, self.symbols)
+        samples = []
+        for _ in range(k):
+            (q, r) = (0, len(table) - 1)
+            insyms = []
+            outsyms = []
+            x = rng.randrange(table[r][0])
+            while True:
+                if self.final[q] != _inf:
+                    if x == 0:
+                        break
+                    x -= 1
+                for i in range(offsets[q], offsets[q+1]):
+                    m = self._arc_length(i)
+                    if m > r:
+                        continue
+                    n = table[r-m][arc_target[i]]
+                    if x < n:
+                        break
+                    x -= n
+                (q, r) = (arc_target[i], r - m)
+                insym = symbols[arc_in[i]]
+                outsym = insym if arc_out[i] == self.COPY else symbols[arc_out[i]]
+                if insym:
+                    insyms.append(insym)
+                if outsym:
+                    outsyms.append(outsym)
+            if self.istransducer:
+                samples.append((_from_pyfoma(insyms), _from_pyfoma(outsyms)))
+            else:
+                samples.append(_from_pyfoma(insyms))
+        return samples
+
+    def _epsilon_order (self, trim):
+        '''
+        The trimmed states in topological order with respect to the arcs that
+        have zero length. Raises ValueError if those arcs form a cycle, in
+        which case path counts are infinite.
+        '''
+        (offsets, arc_target) = (self.offsets, self.arc_target)
+        indegree = dict.fromkeys(trim, 0)
+        for q in trim:
+            for i in range(offsets[q], offsets[q+1]):
+                if arc_target[i] in trim and not self._arc_length(i):
+                    indegree[arc_target[i]] += 1
+        order = [q for (q, n) in indegree.items() if n == 0]
+        for q in order:
+            for i in range(offsets[q], offsets[q+1]):
+                r = arc_target[i]
+                if r in trim and not self._arc_length(i):
+                    indegree[r] -= 1
+                    if indegree[r] == 0:
+                        order.append(r)
+        if len(order) < len(trim):
+            raise ValueError('Epsilon cycle: path counts are infinite')
+        return order
+
+    def _closure (self, qs):
+        '''
+        The live states reachable from qs by arcs with epsilon on both sides.
+        '''
+        (offsets, arc_in, arc_out, arc_target) = (self.offsets, self.arc_in, self.arc_out, self.arc_target)
+        live = self._live()
+        states = builtins.set(qs)
+        agenda = list(states)
+        while agenda:
+            q = agenda.pop()
+            i = offsets[q]
+            hi = offsets[q+1]
+            while i < hi and arc_in[i] == 0:
+                r = arc_target[i]
+                if arc_out[i] == 0 and r not in states:
+                    states.add(r)
+                    agenda.append(r)
+                i += 1
+        return frozenset(q for q in states if q in live)
+
+    def __iter__ (self):
+        '''
+        The strings of the language, or the (input, output) pairs of a
+        transducer, in shortlex order: by length, then by repr, the order
+        that Enum sorts into. The items of each length are found together,
+        from the items one and two symbols shorter, each paired with the set
+        of states that it leads to. That removes duplicates without
+        remembering everything generated so far: memory is bounded by the
+        frontier of the three current lengths, plus a table of the moves
+        from each set of states.
+        '''
+        istransducer = self.istransducer
+        start = self._closure([0])
+        if not start:
+            return
+        moves = {}
+        levels = {0: {((), ()) if istransducer else (): start}}
+        length = 0
+        while levels:
+            level = levels.pop(length, {})
+            items = []
+            for (key, qs) in level.items():
+                if any(self.final[q] != _inf for q in qs):
+                    if istransducer:
+                        items.append((_from_pyfoma(key[0]), _from_pyfoma(key[1])))
+                    else:
+                        items.append(_from_pyfoma(key))
+            items.sort(key=repr)
+            yield from items
+            for (key, qs) in level.items():
+                successors = moves.get(qs)
+                if successors is None:
+                    successors = moves[qs] = self._moves(qs)
+                for (insym, outsym, qs2) in successors:
+                    if not istransducer:
+                        (k, key2) = (1, key + (insym,))
+                    else:
+                        k = bool(insym) + bool(outsym)
+                        key2 = (key[0] + (insym,) if insym else key[0], key[1] + (outsym,) if outsym else key[1])
+                    following = levels.get(length + k)
+                    if following is None:
+                        following = levels[length + k] = {}
+                    qs1 = following.get(key2)
+                    following[key2] = qs2 if qs1 is None else qs1 | qs2
+            length += 1
+
+    def _moves (self, qs):
+        '''
+        The moves from the set of states qs, grouped by label, as (input,
+        output, states) triples; arcs with epsilon on both sides are left out.
+        '''
+        (offsets, arc_in, arc_out, arc_target, symbols) = \
+            (self.offsets, self.arc_in, self.arc_out, self.arc_target, self.symbols)
+        targets = {}
+        for q in qs:
+            for i in range(offsets[q], offsets[q+1]):
+                (insym, outsym) = (arc_in[i], arc_out[i])
+                if insym == 0 and outsym == 0:
+                    continue
+                targets.setdefault((insym, outsym), []).append(arc_target[i])
+        moves = []
+        for ((insym, outsym), qs2) in targets.items():
+            qs2 = self._closure(qs2)
+            if qs2:
+                insym = symbols[insym]
+                outsym = insym if outsym == self.COPY else symbols[outsym]
+                moves.append((insym, outsym, qs2))
+        return moves
+
+    def _step (self, q, sym):
+        '''
+        The arcs leaving state q that read the pyfoma symbol sym, as (output,
+        target, weight) triples. If sym is None, the arcs with epsilon input.
+        '''
+        if sym is None:
+            insym = 0
+        else:
+            insym = self.symbol_ids.get(sym, self.symbol_ids.get('.'))
+            if insym is None:
+                return []
+        (lo, hi) = (self.offsets[q], self.offsets[q+1])
+        i = bisect_left(self.arc_in, insym, lo, hi)
+        j = bisect_right(self.arc_in, insym, i, hi)
+        (arc_out, symbols) = (self.arc_out, self.symbols)
+        return [(sym if arc_out[k] == self.COPY else symbols[arc_out[k]], self.arc_target[k], self.arc_weight[k])
+                for k in range(i, j)]
+
+    def _accepts (self, x):
+        word = self._encode(x)
+        n = len(word)
+        (offsets, arc_in, arc_target, final) = (self.offsets, self.arc_in, self.arc_target, self.final)
+        agenda = [(0, 0)]
+        visited = {(0, 0)}
+        while agenda:
+            (q, pos) = agenda.pop()
+            if pos == n and final[q] != _inf:
+                return True
+            hi = offsets[q+1]
+            i = offsets[q]
+            nexts = []
+            while i < hi and arc_in[i] == 0:
+                nexts.append((arc_target[i], pos))
+                i += 1
+            if pos < n and word[pos][0] is not None:
+                insym = word[pos][0]
+                j = bisect_left(arc_in, insym, i, hi)
+                while j < hi and arc_in[j] == insym:
+                    nexts.append((arc_target[j], pos + 1))
+                    j += 1
+            for item in nexts:
+                if item not in visited:
+                    visited.add(item)
+                    agenda.append(item)
+        return False
+
+    def freeze (self):
+        return self
+
+    def close (self):
+        '''
+        Release the arrays, if they are views of a buffer such as a shared
+        memory segment, and close the buffer. The machine cannot be used
+        afterwards.
+        '''
+        for machine in (self, self._inverse):
+            if machine is not None:
+                for a in (machine.offsets, machine.arc_in, machine.arc_out,
+                          machine.arc_target, machine.arc_weight, machine.final):
+                    if isinstance(a, memoryview):
+                        a.release()
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+
+    def is_deterministic (self):
+        '''
+        True if no state has an epsilon arc or two arcs with the same input.
+        '''
+        if self._deterministic is None:
+            self._deterministic = True
+            for q in range(self.nstates()):
+                (lo, hi) = (self.offsets[q], self.offsets[q+1])
+                if lo < hi and self.arc_in[lo] == 0:
+                    self._deterministic = False
+                    break
+                if any(self.arc_in[i] == self.arc_in[i+1] for i in range(lo, hi - 1)):
+                    self._deterministic = False
+                    break
+        return self._deterministic
+
+    def _dense_table (self):
+        '''
+        Returns (machine, delta, out, accept), where machine is a
+        deterministic equivalent of this machine, delta and out are NumPy
+        tables indexed by state and symbol, and accept is indexed by state.
+        Row nstates is a dead state. Column nsymbols is for padding, and
+        leaves the state unchanged; column nsymbols+1 is for unknown symbols.
+        Returns None if no deterministic machine is available, which
+        happens with transducers that are not input-deterministic.
+        '''
+        if self._dense is None:
+            import numpy as np
+            machine = self
+            if not machine.is_deterministic():
+                machine = FSA(self.fst(), self.istransducer).compile().freeze()
+            if not machine.is_deterministic():
+                self._dense = (None,)
+                return None
+            nstates = machine.nstates()
+            nsyms = len(machine.symbols)
+            delta = np.full((nstates + 1, nsyms + 2), nstates, dtype=np.int64)
+            delta[:, nsyms] = np.arange(nstates + 1)
+            out = np.zeros((nstates + 1, nsyms + 2), dtype=np.int64)
+            for q in range(nstates):
+                for i in range(machine.offsets[q], machine.offsets[q+1]):
+                    delta[q, machine.arc_in[i]] = machine.arc_target[i]
+                    out[q, machine.arc_in[i]] = machine.arc_out[i]
+            accept = np.zeros(nstates + 1, dtype=bool)
+            accept[:nstates] = np.array(machine.final) != _inf
+            self._dense = (machine, delta, out, accept)
+        return self._dense if self._dense[0] is not None else None
+
+    def _encode_batch (self, machine, seqs):
+        import numpy as np
+        ids = machine.symbol_ids
+        nsyms = len(machine.symbols)
+        unknown = ids.get('.', nsyms + 1)
+        words = [[_sym_to_pyfoma(sym) for sym in coerce(x, Sequence)] for x in seqs]
+        width = max((len(word) for word in words), default=0)
+        codes = np.full((len(words), width), nsyms, dtype=np.int64)
+        for (i, word) in enumerate(words):
+            codes[i, :len(word)] = [ids.get(sym, unknown) for sym in word]
+        return (words, codes)
+
+    def _run_batch (self, seqs, batchsize, outputs):
+        import numpy as np
+        table = self._dense_table()
+        it = iter(seqs)
+        while True:
+            batch = list(itertools.islice(it, batchsize))
+            if not batch:
+                break
+            if table is None:
+                yield (batch, None, None, None)
+                continue
+            (machine, delta, out, accept) = table
+            (words, codes) = self._encode_batch(machine, batch)
+            states = np.zeros(len(words), dtype=np.int64)
+            outsyms = np.zeros(codes.shape, dtype=np.int64) if outputs else None
+            for t in range(codes.shape[1]):
+                if outputs:
+                    outsyms[:, t] = out[states, codes[:, t]]
+                states = delta[states, codes[:, t]]
+            yield (words, accept[states], outsyms, machine)
+
+    def contains_many (self, seqs, batchsize=4096):
+        '''
+        Membership for many inputs at once. The inputs advance through a
+        dense transition table together, using NumPy. Returns a boolean
+        array.
+        '''
+        import numpy as np
+        results = []
+        for (words, accepted, _, _) in self._run_batch(seqs, batchsize, False):
+            if accepted is None:
+                accepted = np.array([x in self for x in words], dtype=bool)
+            results.append(accepted)
+        return np.concatenate(results) if results else np.zeros(0, dtype=bool)
+
+    def map (self, seqs, batchsize=4096):
+        '''
+        Returns a list containing, for each input, its cheapest output, or
+        None if the input is not accepted. Deterministic machines are run
+        in batches, as in contains_many().
+        '''
+        results = []
+        for (words, accepted, outsyms, machine) in self._run_batch(seqs, batchsize, True):
+            if accepted is None:
+                results.extend(next(self._call(x), None) for x in words)
+                continue
+            for (i, word) in enumerate(words):
+                if not accepted[i]:
+                    results.append(None)
+                    continue
+                syms = []
+                for (t, outsym) in enumerate(outsyms[i, :len(word)]):
+                    syms.append(word[t] if outsym == self.COPY else machine.symbols[outsym])
+                results.append(_from_pyfoma(syms))
+        return results
+
+    def _call (self, x, invert=False, costs=False):
+        machine = self.inverse() if invert else self
+        return machine._apply(x, costs)
+
+    def __call__ (self, x, invert=False, k=None):
+        '''
+        The outputs for input x. If k is given, the k cheapest outputs in
+        order of cost; otherwise the first ten, in shortlex order.
+        '''
+        op = 'inv' if invert else 'call'
+        if k is None:
+            return self._cached(op, x, lambda: Enum(self._call(x, invert=invert)))
+        return self._cached((op, k), x, lambda: Enum(self._call(x, invert=invert), k, ordered=True))
+
+    def inv (self, x, k=None):
+        return self.__call__(x, invert=True, k=k)
+
+    def kbest (self, x, k=5, invert=False):
+        '''
+        A list of up to k (output, cost) pairs for input x, cheapest first.
+        The search stops as soon as the k-th output is found.
+        '''
+        return list(itertools.islice(self._call(x, invert, costs=True), k))
+
+    def lookup_approx (self, x, max_edits=1, k_best=10, substitution=1., insertion=1., deletion=1.):
+        '''
+        A list of up to k_best (output, cost) pairs, cheapest first, for the
+        inputs that the machine accepts within max_edits edits of x. For an
+        acceptor, the outputs are the accepted strings themselves. The cost
+        is the sum of the edit costs and the weights along the path. An
+        insertion is a symbol of x that is skipped, a deletion is a symbol
+        that the machine reads but x lacks, and a substitution is a symbol
+        of x read as a different symbol. The machine is walked directly,
+        best first, with the number of edits carried along: a branch is
+        cut as soon as it can no longer reach acceptance at the end of x
+        within max_edits edits, so only the neighbourhood of x within the
+        edit bound is visited. Each (position, state, edits) is expanded
+        for at most k_best distinct outputs so far, since any result that
+        extends a later one is beaten by extending each of the first k_best
+        the same way; this also stops loops that only write output. Wildcard
+        arcs match but are not edited.
+        '''
+        word = self._encode(x)
+        n = len(word)
+        (offsets, arc_in, arc_out, arc_target, arc_weight, final) = \
+            (self.offsets, self.arc_in, self.arc_out, self.arc_target, self.arc_weight, self.final)
+        (symbols, COPY) = (self.symbols, self.COPY)
+        wildcard = self.symbol_ids.get('.')
+        results = []
+        viable = self._viable_approx(word, max_edits)
+        if (0, 0, 0) not in viable or k_best <= 0:
+            return results
+        counter = itertools.count()
+        queue = [(0.0, 0, 0, next(counter), None, 0)]
+        visited = builtins.set()
+        expanded = {}
+        seen = builtins.set()
+        def push (cost, edits, pos, out, output, q):
+            if (pos, q, edits) in viable:
+                heapq.heappush(queue, (cost, edits, pos, next(counter), (out, output) if out else output, q))
+        while queue:
+            (cost, edits, pos, _, output, q) = heapq.heappop(queue)
+            if q < 0:
+                syms = []
+                while output is not None:
+                    (sym, output) = output
+                    syms.append(sym)
+                syms.reverse()
+                y = _from_pyfoma(syms)
+                if y not in seen:
+                    seen.add(y)
+                    results.append((y, cost))
+                    if len(results) >= k_best:
+                        break
+                continue
+            if (pos, q, edits, output) in visited or expanded.get((pos, q, edits), 0) >= k_best:
+                continue
+            visited.add((pos, q, edits, output))
+            expanded[pos, q, edits] = expanded.get((pos, q, edits), 0) + 1
+            if pos == n and final[q] != _inf:
+                heapq.heappush(queue, (cost + final[q], edits, pos, next(counter), output, -1))
+            if pos < n:
+                push(cost + insertion, edits + 1, pos + 1, None, output, q)
+            (insym, sym) = word[pos] if pos < n else (None, None)
+            for i in range(offsets[q], offsets[q+1]):
+                a = arc_in[i]
+                (w, r) = (arc_weight[i], arc_target[i])
+                if a == 0:
+                    push(cost + w, edits, pos, symbols[arc_out[i]], output, r)
+                elif a == insym:
+                    push(cost + w, edits, pos + 1, sym if arc_out[i] == COPY else symbols[arc_out[i]], output, r)
+                elif a != wildcard and edits < max_edits:
+                    out = symbols[arc_out[i]]
+                    push(cost + w + deletion, edits + 1, pos, out, output, r)
+                    if pos < n:
+                        push(cost + w + substitution, edits + 1, pos + 1, out, output, r)
+        return results
+
+    def _viable_approx (self, word, max_edits):
+        '''
+        The (pos, state, edits) triples of lookup_approx() from which the
+        rest of the word can be accepted within max_edits edits. As in
+        _viable(), a forward pass finds the triples reachable from the
+        start, ignoring output, and a backward pass keeps those that lead
+        on to acceptance.
+        '''
+        (offsets, arc_in, arc_target, final) = (self.offsets, self.arc_in, self.arc_target, self.final)
+        wildcard = self.symbol_ids.get('.')
+        n = len(word)
+        start = (0, 0, 0)
+        successors = {start: []}
+        agenda = [start]
+        while agenda:
+            (pos, q, edits) = triple = agenda.pop()
+            insym = word[pos][0] if pos < n else None
+            nexts = successors[triple]
+            if pos < n and edits < max_edits:
+                nexts.append((pos + 1, q, edits + 1))
+            for i in range(offsets[q], offsets[q+1]):
+                (a, r) = (arc_in[i], arc_target[i])
+                if a == 0:
+                    nexts.append((pos, r, edits))
+                elif a == insym:
+                    nexts.append((pos + 1, r, edits))
+                elif a != wildcard and edits < max_edits:
+                    nexts.append((pos, r, edits + 1))
+                    if pos < n:
+                        nexts.append((pos + 1, r, edits + 1))
+            for t in nexts:
+                if t not in successors:
+                    successors[t] = []
+                    agenda.append(t)
+        predecessors = {}
+        for (triple, nexts) in successors.items():
+            for t in nexts:
+                predecessors.setdefault(t, []).append(triple)
+        viable = builtins.set(t for t in successors if t[0] == n and final[t[1]] != _inf)
+        agenda = list(viable)
+        while agenda:
+            for t in predecessors.get(agenda.pop(), ()):
+                if t not in viable:
+                    viable.add(t)
+                    agenda.append(t)
+        return viable
+
+    def __contains__ (self, x):
+        return self._cached('contains', x, lambda: self._accepts(x))
+
+    def _results_owner (self):
+        # a frozen machine never changes
+        return self
+
+    def __bare__ (self):
+        a = 'T' if self.istransducer else 'A'
+        return f'(frozen FS{a} with {self.nstates()} states)'
+
+    def __repr__ (self):
+        return self.__bare__()
+
+
+#--  Lazy determinization  -----------------------------------------------------
+
+class LazyDFA (object):
+    '''
+    Lookup in a frozen machine that is determinized as it goes. A state of
+    the DFA is the set of machine states reachable on some input, closed
+    under arcs with epsilon input. Subset states and their transitions are
+    built only when an input reaches them, and are kept in an LRU table of
+    up to cachesize subset states (None means no limit). For a transducer,
+    the DFA is over the input side: it decides quickly whether an input has
+    any outputs, and __call__() only searches the machine for inputs that do.
+    '''
+
+    def __init__ (self, frozen, cachesize=10000):
+        self.frozen = frozen
+        self.cachesize = cachesize
+        self.table = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.start = self._closure([0])
+
+    def _closure (self, qs):
+        (offsets, arc_in, arc_target) = (self.frozen.offsets, self.frozen.arc_in, self.frozen.arc_target)
+        states = builtins.set(qs)
+        agenda = list(states)
+        while agenda:
+            q = agenda.pop()
+            i = offsets[q]
+            hi = offsets[q+1]
+            while i < hi and arc_in[i] == 0:
+                r = arc_target[i]
+                if r not in states:
+                    states.add(r)
+                    agenda.append(r)
+                i += 1
+        return tuple(sorted(states))
+
+    def _entry (self, subset):
+        entry = self.table.get(subset)
+        if entry is None:
+            final = self.frozen.final
+            entry = self.table[subset] = (any(final[q] != _inf for q in subset), {})
+            if self.cachesize is not None and len(self.table) > self.cachesize:
+                self.table.popitem(last=False)
+        else:
+            self.table.move_to_end(subset)
+        return entry
+
+    def _next (self, subset, insym):
+        with self.lock:
+            row = self._entry(subset)[1]
+            target = row.get(insym)
+            if target is not None:
+                self.hits += 1
+                return target
+            self.misses += 1
+        (offsets, arc_in, arc_target) = (self.frozen.offsets, self.frozen.arc_in, self.frozen.arc_target)
+        qs = []
+        for q in subset:
+            hi = offsets[q+1]
+            i = bisect_left(arc_in, insym, offsets[q], hi)
+            while i < hi and arc_in[i] == insym:
+                qs.append(arc_target[i])
+                i += 1
+        target = self._closure(qs)
+        with self.lock:
+            row[insym] = target
+        return target
+
+    def __contains__ (self, x):
+        subset = self.start
+        for (insym, sym) in self.frozen._encode(x):
+            if insym is None:
+                return False
+            subset = self._next(subset, insym)
+            if not subset:
+                return False
+        with self.lock:
+            return self._entry(subset)[0]
+
+    def contains_many (self, seqs):
+        return [x in self for x in seqs]
+
+    def __call__ (self, x):
+        if x in self:
+            return self.frozen(x)
+        else:
+            return Enum(())
+
+    def __len__ (self):
+        return len(self.table)
+
+    def clear (self):
+        with self.lock:
+            self.table.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __repr__ (self):
+        return f'<LazyDFA {len(self.table)} subsets, {self.hits} hits, {self.misses} misses>'
+
+
+#--  Lazy composition  ---------------------------------------------------------
+
+class LazyComposition (Composition):
+    '''
+    A composition that is not built as a whole for lookup. __call__() and
+    inv() run the frozen component machines in lockstep, expanding only the
+    product states that the input reaches. Expansions are kept in an LRU
+    cache of up to cachesize entries, shared by all lookups; cachesize=None
+    means no limit and cachesize=0 turns the cache off. The machine for the
+    whole composition is still built if the language is compiled or used in
+    a larger expression.
+    '''
+
+    def __init__ (self, args, cachesize=10000):
+        Composition.__init__(self, list(_flatten(Composition, args)))
+        self.cachesize = cachesize
+        self._machines = {}
+        self._cache = {False: OrderedDict(), True: OrderedDict()}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _components (self, invert):
+        machines = self._machines.get(invert)
+        if machines is None:
+            machines = [arg.freeze() for arg in self.args]
+            if invert:
+                machines = [m.inverse() for m in reversed(machines)]
+            self._machines[invert] = machines
+        return machines
+
+    @staticmethod
+    def _expand (machines, qs, sym):
+        '''
+        The moves of the product from the states qs, as (states, output,
+        weight) triples. If sym is given, the first machine reads it.
+        Otherwise, one machine takes an arc with epsilon input, and the
+        machines before it stay put. Each output is read by the next machine,
+        until a machine outputs epsilon or the last machine is reached.
+        '''
+        n = len(machines)
+        moves = []
+        def feed (k, qs, sym, weight):
+            for (out, q, w) in machines[k]._step(qs[k], sym):
+                qs2 = qs[:k] + (q,) + qs[k+1:]
+                if out and k+1 < n:
+                    feed(k+1, qs2, out, weight + w)
+                else:
+                    moves.append((qs2, out, weight + w))
+        if sym is not None:
+            feed(0, qs, sym, 0.)
+        else:
+            for k in range(n):
+                for (out, q, w) in machines[k]._step(qs[k], None):
+                    qs2 = qs[:k] + (q,) + qs[k+1:]
+                    if out and k+1 < n:
+                        feed(k+1, qs2, out, w)
+                    else:
+                        moves.append((qs2, out, w))
+        return moves
+
+    def _moves (self, machines, cache, qs, sym):
+        if self.cachesize == 0:
+            return self._expand(machines, qs, sym)
+        key = (qs, sym)
+        with self.lock:
+            moves = cache.get(key)
+            if moves is not None:
+                self.hits += 1
+                cache.move_to_end(key)
+                return moves
+            self.misses += 1
+        moves = self._expand(machines, qs, sym)
+        with self.lock:
+            cache[key] = moves
+            if self.cachesize is not None and len(cache) > self.cachesize:
+                cache.popitem(last=False)
+        return moves
+
+    def _viable (self, machines, cache, word):
+        '''
+        The (pos, states) pairs of the product from which the rest of the
+        word can be accepted, found as FrozenFSA._viable() finds them: a
+        forward pass over the pairs that the word reaches, ignoring output,
+        and a backward pass that keeps those that lead on to acceptance.
+        '''
+        n = len(word)
+        start = (0, (0,) * len(machines))
+        successors = {start: []}
+        agenda = [start]
+        while agenda:
+            (pos, qs) = pair = agenda.pop()
+            nexts = successors[pair]
+            nexts.extend((pos, qs2) for (qs2, _, _) in self._moves(machines, cache, qs, None))
+            if pos < n:
+                nexts.extend((pos + 1, qs2) for (qs2, _, _) in self._moves(machines, cache, qs, word[pos]))
+            for p in nexts:
+                if p not in successors:
+                    successors[p] = []
+                    agenda.append(p)
+        predecessors = {}
+        for (pair, nexts) in successors.items():
+            for p in nexts:
+                predecessors.setdefault(p, []).append(pair)
+        viable = builtins.set((pos, qs) for (pos, qs) in successors
+                              if pos == n and all(m.final[q] != _inf for (m, q) in zip(machines, qs)))
+        agenda = list(viable)
+        while agenda:
+            for p in predecessors.get(agenda.pop(), ()):
+                if p not in viable:
+                    viable.add(p)
+                    agenda.append(p)
+        return viable
+
+    def _lookup (self, x, invert=False):
+        '''
+        Generate the distinct outputs for input x, cheapest first, searching
+        the product as FrozenFSA._apply() searches a single machine. Only
+        product states from which the rest of the input can be accepted are
+        visited, so loops that lead nowhere are not followed.
+        '''
+        machines = self._components(invert)
+        cache = self._cache[invert]
+        word = [_sym_to_pyfoma(sym) for sym in coerce(x, Sequence)]
+        n = len(word)
+        viable = self._viable(machines, cache, word)
+        if (0, (0,) * len(machines)) not in viable:
+            return
+        counter = itertools.count()
+        queue = [(0.0, 0, next(counter), None, (0,) * len(machines))]
+        visited = {}
+        seen = builtins.set()
+        while queue:
+            (cost, negpos, _, output, qs) = heapq.heappop(queue)
+            pos = -negpos
+            if qs is None:
+                syms = []
+                while output is not None:
+                    (sym, output) = output
+                    syms.append(sym)
+                syms.reverse()
+                y = _from_pyfoma(syms)
+                if y not in seen:
+                    seen.add(y)
+                    yield y
+                continue
+            # Keeping the output in the table keeps its id from being reused
+            key = (pos, qs, id(output))
+            if key in visited:
+                continue
+            visited[key] = output
+            if pos == n and all(m.final[q] != _inf for (m, q) in zip(machines, qs)):
+                final = sum(m.final[q] for (m, q) in zip(machines, qs))
+                heapq.heappush(queue, (cost + final, negpos, next(counter), output, None))
+            for (qs2, out, w) in self._moves(machines, cache, qs, None):
+                if (pos, qs2) in viable:
+                    heapq.heappush(queue, (cost + w, negpos, next(counter), (out, output) if out else output, qs2))
+            if pos < n:
+                for (qs2, out, w) in self._moves(machines, cache, qs, word[pos]):
+                    if (pos + 1, qs2) in viable:
+                        heapq.heappush(queue, (cost + w, negpos - 1, next(counter), (out, output) if out else output, qs2))
+
+    def __call__ (self, x, invert=False):
+        return Enum(self._lookup(x, invert))
+
+    def inv (self, x):
+        return self.__call__(x, invert=True)
+
+    def __contains__ (self, x):
+        try:
+            next(self._lookup(x))
+            return True
+        except StopIteration:
+            return False
+
+    def clear_cache (self):
+        with self.lock:
+            for cache in self._cache.values():
+                cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+#--  Flat layout  --------------------------------------------------------------
+#
+#  A frozen machine as a single buffer: a header, then the arrays of the
+#  machine and of its inverse, then the symbol table. The arrays are 8-byte
+#  integers and doubles, in native byte order, and are used in place.
+
+_layout_magic = b'UMLFSA\0\0'
+_layout_version = 1
+_layout_header = struct.Struct('<8sIIqqq')
+_LITTLE_ENDIAN = 1
+_TRANSDUCER = 2
+
+def _layout_arrays (frozen):
+    inverse = frozen.inverse()
+    return [frozen.offsets, frozen.arc_in, frozen.arc_out, frozen.arc_target, frozen.arc_weight,
+            frozen.final,
+            inverse.offsets, inverse.arc_in, inverse.arc_out, inverse.arc_target, inverse.arc_weight]
+
+def _pack_symbols (symbols):
+    return '\n'.join(repr(sym) for sym in symbols).encode('utf8')
+
+def _unpack_symbols (data):
+    return [ast.literal_eval(line) for line in bytes(data).decode('utf8').split('\n')]
+
+def _layout_chunks (frozen):
+    '''
+    The layout of frozen, as a list of byte buffers to be written in order.
+    '''
+    symtab = _pack_symbols(frozen.symbols)
+    flags = (_LITTLE_ENDIAN if sys.byteorder == 'little' else 0) | (_TRANSDUCER if frozen.istransducer else 0)
+    header = _layout_header.pack(_layout_magic, _layout_version, flags,
+                                 frozen.nstates(), frozen.narcs(), len(symtab))
+    arrays = [memoryview(a).cast('B') for a in _layout_arrays(frozen)]
+    return [header] + arrays + [symtab]
+
+def _layout_size (frozen):
+    return sum(len(chunk) for chunk in _layout_chunks(frozen))
+
+def _pack_layout (frozen, buf):
+    '''
+    Write frozen into the writable buffer buf, which must be at least
+    _layout_size(frozen) bytes long.
+    '''
+    buf = memoryview(buf).cast('B')
+    offset = 0
+    for chunk in _layout_chunks(frozen):
+        buf[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+    return offset
+
+def _unpack_layout (buf):
+    '''
+    Returns a FrozenFSA whose arrays are read-only views of buf.
+    '''
+    buf = memoryview(buf).cast('B').toreadonly()
+    (magic, version, flags, nstates, narcs, symlen) = _layout_header.unpack_from(buf, 0)
+    if magic != _layout_magic:
+        raise ValueError('Not a frozen machine')
+    if version != _layout_version:
+        raise ValueError(f'Unsupported format version: {version}')
+    if bool(flags & _LITTLE_ENDIAN) != (sys.byteorder == 'little'):
+        raise ValueError('Machine was saved with a different byte order')
+    offset = _layout_header.size
+    arrays = []
+    for (n, code) in [(nstates + 1, 'q'), (narcs, 'q'), (narcs, 'q'), (narcs, 'q'), (narcs, 'd'),
+                      (nstates, 'd'),
+                      (nstates + 1, 'q'), (narcs, 'q'), (narcs, 'q'), (narcs, 'q'), (narcs, 'd')]:
+        arrays.append(buf[offset:offset + 8 * n].cast(code))
+        offset += 8 * n
+    symbols = _unpack_symbols(buf[offset:offset + symlen])
+    istransducer = bool(flags & _TRANSDUCER)
+    final = arrays[5]
+    frozen = FrozenFSA.from_arrays(symbols, *arrays[:5], final, istransducer)
+    inverse = FrozenFSA.from_arrays(symbols, *arrays[6:], final, istransducer)
+    frozen._inverse = inverse
+    inverse._inverse = frozen
+    return frozen
+
+
+#--  Save and load  ------------------------------------------------------------
+
+def save (lang, path):
+    '''
+    Save the frozen machine for lang to a file, in the flat layout.
+    '''
+    frozen = coerce(lang, Language).freeze()
+    with open(path, 'wb') as f:
+        for chunk in _layout_chunks(frozen):
+            f.write(chunk)
+
+def load (path, mmap=True):
+    '''
+    Load a machine saved with save(). If mmap is true, the file is mapped
+    into memory rather than read, and the operating system pages in the
+    parts of the machine that lookups touch. The result is a FrozenFSA.
+    '''
+    with open(path, 'rb') as f:
+        if mmap:
+            buf = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ)
+        else:
+            buf = f.read()
+    fsa = _unpack_layout(buf)
+    if mmap:
+        fsa.buffer = buf
+    return fsa
+
+
+#--  Shared memory  ------------------------------------------------------------
+
+class SharedFSA (object):
+    '''
+    A frozen machine exported to a shared memory segment. The process that
+    creates it owns the segment and should call unlink() when it is no longer
+    needed. Other processes call attach(name) to use the machine in place.
+    '''
+
+    def __init__ (self, lang, name=None):
+        frozen = coerce(lang, Language).freeze()
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=_layout_size(frozen))
+        _pack_layout(frozen, self.shm.buf)
+        self.name = self.shm.name
+        _owned_segments.add(self.name)
+        self.fsa = _unpack_layout(self.shm.buf)
+
+    def close (self):
+        if self.fsa is not None:
+            self.fsa.close()
+            self.fsa = None
+            self.shm.close()
+
+    def unlink (self):
+        self.close()
+        self.shm.unlink()
+        _owned_segments.discard(self.name)
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *args):
+        self.unlink()
+
+    def __repr__ (self):
+        return f'<SharedFSA {self.name}: {self.fsa}>'
+
+
+_owned_segments = builtins.set()
+
+def share (lang, name=None):
+    return SharedFSA(lang, name)
+
+def attach (name):
+    '''
+    Returns a read-only FrozenFSA that uses the shared memory segment with
+    the given name in place.
+    '''
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13, attaching registers the segment with the
+        # resource tracker, which would destroy it when this process exits.
+        # The owner's registration is left alone.
+        shm = shared_memory.SharedMemory(name=name)
+        if name not in _owned_segments:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+    fsa = _unpack_layout(shm.buf)
+    fsa.buffer = shm
+    # The views must be released before the segment is closed, when the
+    # machine is collected or at exit. The finalizer holds the views and
+    # the segment, but not the machine, so that it can be collected.
+    views = [a for machine in (fsa, fsa._inverse)
+             for a in (machine.offsets, machine.arc_in, machine.arc_out,
+                       machine.arc_target, machine.arc_weight, machine.final)]
+    weakref.finalize(fsa, _release_buffer, views, shm)
+    return fsa
+
+def _release_buffer (views, buffer):
+    for view in views:
+        if isinstance(view, memoryview):
+            view.release()
+    buffer.close()
+
+
+#--  Batch application  --------------------------------------------------------
+
+# set in each pool worker by _batch_init(), and only there
+_batch_machine = None
+
+def _batch_init (machine, invert, n):
+    global _batch_machine
+    _batch_machine = (machine, invert, n)
+
+def _batch_chunk (chunk):
+    return _apply_chunk(*_batch_machine, chunk)
+
+def _apply_chunk (machine, invert, n, chunk):
+    return [Enum(machine._call(x, invert=invert), n) for x in chunk]
+
+def apply_batch (lang, xs, workers=None, chunksize=256, invert=False, n=10):
+    '''
+    Apply lang to each input in xs, using a pool of worker processes. The
+    frozen machine is sent to each worker once, when the pool starts. Inputs
+    are sent in chunks, and at most two chunks per worker are in flight at
+    any time. Yields (input, outputs) pairs in input order, where outputs is
+    an Enum of at most n outputs, as returned by __call__().
+    '''
+    machine = coerce(lang, Language).freeze()
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunks = (list(chunk) for chunk in _chunks(xs, chunksize))
+    if workers <= 1:
+        for chunk in chunks:
+            yield from zip(chunk, _apply_chunk(machine, invert, n, [coerce(x, Sequence) for x in chunk]))
+        return
+    with multiprocessing.Pool(workers, _batch_init, (machine, invert, n)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            seqs = [coerce(x, Sequence) for x in chunk]
+            pending.append((chunk, pool.apply_async(_batch_chunk, (seqs,))))
+            if len(pending) >= 2 * workers:
+                (chunk, result) = pending.popleft()
+                yield from zip(chunk, result.get())
+        while pending:
+            (chunk, result) = pending.popleft()
+            yield from zip(chunk, result.get())
+
+def _chunks (xs, size):
+    it = iter(xs)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 def show (x):
     if hasattr(x, '__show__'):
         x.__show__()
@@ -920,14 +3738,11 @@ class Coercion (object):
 #--  Globals  ------------------------------------------------------------------
 
 coerce = Coercion()
+_inf = float('inf')
+_compile_cache = CompileCache()
 epsilon = Sequence([])
 emptyset = EnumSet([])
-_fsa_builder = FSABuilder()
-E = _fsa_builder.E
-F = _fsa_builder.F
-make_fsa = _fsa_builder.make_fsa
-erase_fsa = _fsa_builder.erase_fsa
-edit = _fsa_builder.edit_fsa
+_fsa_builders = contextvars.ContextVar('fsa_builder')
 at = Atoms()
 anysym = Other('anysym')
 other = Other('other')
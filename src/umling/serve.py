@@ -0,0 +1,400 @@
+'''
+Serving compiled machines to asyncio code and over HTTP.
+
+    registry = Registry()
+    registry.add('nouns', nouns)
+    outputs = await registry.lookup('nouns', letters('cats'))
+
+A registry keeps frozen machines in memory under names. Lookups run on a
+thread pool, so they do not block the event loop, and lookups for the same
+machine that arrive within a short delay of each other are run as one
+batch. start_server() serves a registry over HTTP on a TCP port or a local
+socket, and loadgen() measures the throughput and latency of a server.
+
+From the command line:
+
+    python -m umling.serve serve --machine nouns=nouns.fsa --port 8080
+    python -m umling.serve load --machine nouns --inputs words.txt --port 8080
+'''
+
+import asyncio, itertools, json, time, argparse, sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs, urlencode
+from umling.pymol import Language, Sequence, Other, coerce, load
+
+
+#--  Registry  -----------------------------------------------------------------
+
+class Registry (object):
+    '''
+    Machines by name, with asyncio lookups. A batch is run when it has
+    batchsize requests or when delay seconds have passed since its first
+    request, whichever comes first. At most n outputs are returned per input.
+    '''
+
+    ops = ('call', 'inv', 'contains')
+
+    def __init__ (self, workers=None, batchsize=64, delay=0.001, n=10):
+        self.machines = {}
+        self.executor = ThreadPoolExecutor(workers)
+        self.batchsize = batchsize
+        self.delay = delay
+        self.n = n
+        self.pending = {}
+        self.batches = 0
+        self.requests = 0
+
+    def add (self, name, lang):
+        '''
+        Register a language under name. It is frozen now, so that the first
+        lookup does not pay for compiling it.
+        '''
+        self.machines[name] = coerce(lang, Language).freeze()
+
+    def load (self, name, path):
+        self.machines[name] = load(path)
+
+    def remove (self, name):
+        del self.machines[name]
+
+    def names (self):
+        return sorted(self.machines)
+
+    def __contains__ (self, name):
+        return name in self.machines
+
+    def _machine (self, name):
+        try:
+            return self.machines[name]
+        except KeyError:
+            raise KeyError(f'No machine named {name!r}') from None
+
+    def _run (self, machine, op, xs):
+        if op == 'contains':
+            return [x in machine for x in xs]
+        results = []
+        for x in xs:
+            outputs = []
+            for y in machine._call(x, invert=(op == 'inv')):
+                if y not in outputs:
+                    outputs.append(y)
+                    if len(outputs) == self.n:
+                        break
+            results.append(outputs)
+        return results
+
+    async def _submit (self, name, op, x):
+        if op not in self.ops:
+            raise ValueError(f'Unknown operation: {op}')
+        self._machine(name)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = (name, op)
+        batch = self.pending.get(key)
+        if batch is None:
+            batch = self.pending[key] = []
+            loop.call_later(self.delay, self._flush, key, batch)
+        batch.append((coerce(x, Sequence), future))
+        if len(batch) >= self.batchsize:
+            self._flush(key, batch)
+        return await future
+
+    def _flush (self, key, batch):
+        if self.pending.get(key) is not batch:
+            return
+        del self.pending[key]
+        (name, op) = key
+        self.batches += 1
+        self.requests += len(batch)
+        try:
+            machine = self._machine(name)
+        except KeyError as e:
+            for (_, future) in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        xs = [x for (x, _) in batch]
+        job = asyncio.get_running_loop().run_in_executor(self.executor, self._run, machine, op, xs)
+
+        def done (job):
+            if job.exception() is not None:
+                for (_, future) in batch:
+                    if not future.done():
+                        future.set_exception(job.exception())
+            else:
+                for ((_, future), result) in zip(batch, job.result()):
+                    if not future.done():
+                        future.set_result(result)
+
+        job.add_done_callback(done)
+
+    async def lookup (self, name, x):
+        return await self._submit(name, 'call', x)
+
+    async def inv (self, name, x):
+        return await self._submit(name, 'inv', x)
+
+    async def contains (self, name, x):
+        return await self._submit(name, 'contains', x)
+
+    async def _run_many (self, name, op, xs):
+        machine = self._machine(name)
+        xs = [coerce(x, Sequence) for x in xs]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._run, machine, op, xs)
+
+    async def lookup_many (self, name, xs):
+        return await self._run_many(name, 'call', xs)
+
+    async def inv_many (self, name, xs):
+        return await self._run_many(name, 'inv', xs)
+
+    async def contains_many (self, name, xs):
+        return await self._run_many(name, 'contains', xs)
+
+    def close (self):
+        self.executor.shutdown()
+
+    def __repr__ (self):
+        return f'<Registry {len(self.machines)} machines, {self.requests} requests in {self.batches} batches>'
+
+
+#--  HTTP  ---------------------------------------------------------------------
+#
+#  GET  /machines
+#  GET  /lookup?machine=NAME&input=SYMBOLS[&op=call|inv|contains]
+#  POST /lookup with {"machine": NAME, "inputs": [SYMBOLS, ...], "op": ...}
+#
+#  SYMBOLS is a string of space-separated symbols, or a list of symbols.
+#  Responses are JSON, and connections are kept alive.
+
+class HTTPError (Exception):
+
+    def __init__ (self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+_reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            500: 'Internal Server Error'}
+
+def _symbols (x):
+    if isinstance(x, str):
+        return Sequence(x.split())
+    elif isinstance(x, list) and all(isinstance(sym, str) for sym in x):
+        return Sequence(x)
+    else:
+        raise HTTPError(400, f'Bad input: {x!r}')
+
+def _jsonable_symbol (sym):
+    if isinstance(sym, str):
+        return sym
+    elif isinstance(sym, Other):
+        return sym.data
+    else:
+        return str(sym)
+
+def _jsonable (result):
+    if isinstance(result, bool):
+        return result
+    return [[_jsonable_symbol(sym) for sym in y] for y in result]
+
+
+async def _handle_request (registry, method, target, body):
+    url = urlsplit(target)
+    if url.path == '/machines':
+        return {'machines': registry.names()}
+    elif url.path != '/lookup':
+        raise HTTPError(404, f'Not found: {url.path}')
+    if method == 'GET':
+        query = {key: values[-1] for (key, values) in parse_qs(url.query).items()}
+        if 'input' not in query:
+            raise HTTPError(400, 'Missing input')
+        (name, op, inputs) = (query.get('machine'), query.get('op', 'call'), [query['input']])
+    elif method == 'POST':
+        try:
+            request = json.loads(body)
+            (name, op, inputs) = (request.get('machine'), request.get('op', 'call'), request['inputs'])
+        except (ValueError, KeyError, AttributeError, TypeError):
+            raise HTTPError(400, 'Expecting JSON with machine and inputs')
+        if not isinstance(inputs, list):
+            raise HTTPError(400, 'Expecting a list of inputs')
+    else:
+        raise HTTPError(405, f'Method not allowed: {method}')
+    try:
+        known = name in registry
+    except TypeError:
+        raise HTTPError(400, f'Bad machine name: {name!r}')
+    if not known:
+        raise HTTPError(404, f'No machine named {name!r}')
+    if op not in registry.ops:
+        raise HTTPError(400, f'Unknown operation: {op}')
+    xs = [_symbols(x) for x in inputs]
+    if method == 'GET':
+        results = [await registry._submit(name, op, xs[0])]
+    else:
+        results = await registry._run_many(name, op, xs)
+    return {'machine': name, 'op': op, 'outputs': [_jsonable(result) for result in results]}
+
+
+async def _handle_connection (registry, reader, writer):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                (method, target, version) = line.decode('latin-1').split()
+            except ValueError:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                (key, _, value) = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+            close = headers.get('connection', '').lower() == 'close' or version == 'HTTP/1.0'
+            try:
+                length = int(headers.get('content-length', 0))
+                if length < 0:
+                    raise ValueError(length)
+            except ValueError:
+                # the body cannot be skipped, so the connection is closed
+                (status, data, close) = (400, json.dumps({'error': 'Bad Content-Length'}), True)
+            else:
+                body = await reader.readexactly(length) if length else b''
+                try:
+                    (status, data) = (200, json.dumps(await _handle_request(registry, method, target, body)))
+                except HTTPError as e:
+                    (status, data) = (e.status, json.dumps({'error': str(e)}))
+                except Exception as e:
+                    (status, data, close) = (500, json.dumps({'error': f'{type(e).__name__}: {e}'}), True)
+            data = data.encode('utf8')
+            writer.write(f'HTTP/1.1 {status} {_reasons[status]}\r\n'
+                         f'Content-Type: application/json\r\n'
+                         f'Content-Length: {len(data)}\r\n'
+                         f'Connection: {"close" if close else "keep-alive"}\r\n\r\n'.encode('latin-1') + data)
+            await writer.drain()
+            if close:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server (registry, host='127.0.0.1', port=8080, path=None):
+    '''
+    Start serving registry over HTTP, on a TCP port or, if path is given, on
+    a Unix domain socket. Returns the asyncio server; port=0 picks a free
+    port, which can be read from server.sockets[0].getsockname().
+    '''
+    def handle (reader, writer):
+        return _handle_connection(registry, reader, writer)
+    if path is not None:
+        return await asyncio.start_unix_server(handle, path)
+    return await asyncio.start_server(handle, host, port)
+
+
+#--  Load generator  -----------------------------------------------------------
+
+async def _client (host, port, path, targets, latencies, errors):
+    if path is not None:
+        (reader, writer) = await asyncio.open_unix_connection(path)
+    else:
+        (reader, writer) = await asyncio.open_connection(host, port)
+    try:
+        for target in targets:
+            start = time.perf_counter()
+            writer.write(f'GET {target} HTTP/1.1\r\nHost: {host}\r\n\r\n'.encode('latin-1'))
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                (key, _, value) = line.decode('latin-1').partition(':')
+                if key.strip().lower() == 'content-length':
+                    length = int(value)
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+def _percentile (xs, p):
+    if not xs:
+        return None
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(p / 100 * len(xs)))]
+
+
+async def loadgen (machine, inputs, requests=1000, concurrency=16, op='call',
+                   host='127.0.0.1', port=8080, path=None):
+    '''
+    Send requests GET lookups to a server over concurrency connections,
+    cycling through inputs, and report throughput and latency (in seconds).
+    '''
+    inputs = [' '.join(x) if not isinstance(x, str) else x for x in inputs]
+    targets = ['/lookup?' + urlencode({'machine': machine, 'input': x, 'op': op})
+               for x in itertools.islice(itertools.cycle(inputs), requests)]
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*(_client(host, port, path, targets[i::concurrency], latencies, errors)
+                           for i in range(concurrency)))
+    seconds = time.perf_counter() - start
+    return {'requests': len(latencies),
+            'errors': len(errors),
+            'seconds': seconds,
+            'throughput': len(latencies) / seconds if seconds else None,
+            'p50': _percentile(latencies, 50),
+            'p99': _percentile(latencies, 99)}
+
+
+#--  Command line  -------------------------------------------------------------
+
+def main (argv=None):
+    parser = argparse.ArgumentParser(prog='python -m umling.serve')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_command = commands.add_parser('serve', help='serve saved machines over HTTP')
+    serve_command.add_argument('--machine', action='append', default=[], metavar='NAME=PATH',
+                               help='a machine saved with umling.pymol.save()')
+    serve_command.add_argument('--workers', type=int)
+    load_command = commands.add_parser('load', help='measure throughput and latency of a server')
+    load_command.add_argument('--machine', required=True)
+    load_command.add_argument('--inputs', required=True, help='a file with one input per line')
+    load_command.add_argument('--requests', type=int, default=1000)
+    load_command.add_argument('--concurrency', type=int, default=16)
+    load_command.add_argument('--op', default='call', choices=Registry.ops)
+    for command in (serve_command, load_command):
+        command.add_argument('--host', default='127.0.0.1')
+        command.add_argument('--port', type=int, default=8080)
+        command.add_argument('--socket', help='a Unix domain socket, instead of host and port')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        registry = Registry(workers=args.workers)
+        for spec in args.machine:
+            (name, _, path) = spec.partition('=')
+            registry.load(name, path)
+        async def run ():
+            server = await start_server(registry, args.host, args.port, args.socket)
+            async with server:
+                await server.serve_forever()
+        asyncio.run(run())
+    else:
+        with open(args.inputs, encoding='utf8') as f:
+            inputs = [line.strip() for line in f if line.strip()]
+        report = asyncio.run(loadgen(args.machine, inputs, args.requests, args.concurrency, args.op,
+                                     args.host, args.port, args.socket))
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()